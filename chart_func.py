@@ -3,6 +3,10 @@ matplotlib.use('Agg')  # GUIバックエンドを使用しない設定
 import matplotlib.pyplot as plt
 from flet.matplotlib_chart import MatplotlibChart
 import numpy as np
+from pattern_model import TICKS_PER_SECOND
+from pattern_render import BitPlaneCache, channel_edges, channel_run_lengths
+
+chart_cache = BitPlaneCache()  # チャート用（1 tick = 1サンプル）のビットプレーン。再生用のキャッシュとは分ける
 
 # start_indexおよびend_indexをインデックスで受け取る関数
 def generate_timing_chart(dataframes, channel_to_display, editing_channel, channel_colors, start_index=0, end_index=None, selected_periods=None):
@@ -12,7 +16,6 @@ def generate_timing_chart(dataframes, channel_to_display, editing_channel, chann
         ax = create_empty_chart(fig, "Channel 0")
         return MatplotlibChart(fig)
     try:
-        time_factors = {'sec.': 1, 'msec.': 1e-3, 'microsec.': 1e-6}
         df_editing = dataframes.get(editing_channel, None)
 
         if end_index is None:
@@ -21,14 +24,17 @@ def generate_timing_chart(dataframes, channel_to_display, editing_channel, chann
                 fig, ax = plt.subplots(figsize=(10, 1.2))
                 ax = create_empty_chart(fig, "Editing Channel")
                 return MatplotlibChart(fig)
-            end_index = len(df_editing['duration'])
-        # 累積時間を計算
-        times = [0]
-        for duration, unit in zip(df_editing['duration'], df_editing['unit']):
-            times.append(times[-1] + duration * time_factors[unit])
+            end_index = len(df_editing)
+        # 累積時間を計算（チャートの変化点リストと同じく、0 nsの行も1 tick分の幅を持つ）
+        editing_ticks = cumulative_ticks(df_editing)
+        times = (editing_ticks / TICKS_PER_SECOND).tolist()
         # 選択されたデータのインデックスを使用して、start_timeとend_timeを計算
         end_time = times[end_index]
         start_time = times[start_index]
+        start_tick, end_tick = editing_ticks[start_index], editing_ticks[end_index]
+        # 全チャネルを1 tick = 1サンプルの変化点リストにコンパイルする（計算量は変化点の数だけで決まる）
+        compiled = chart_cache.compile(dataframes, TICKS_PER_SECOND)
+        channel_bits = {name: bit for bit, name in enumerate(dataframes)}
         # start_timeからend_timeの時間をもとに時間軸の単位を選定
         if end_time - start_time < 1e-3:
             unit_label = "time [μs]"
@@ -57,49 +63,14 @@ def generate_timing_chart(dataframes, channel_to_display, editing_channel, chann
                 axs[idx].set_ylabel("Ch" + channel.split()[-1]) # y軸のラベルを設定
                 continue
 
-            states = df['state'].apply(lambda x: 1 if x == 'high' else 0).tolist()
-            if not states:
-                print(f"チャンネル {channel} のstatesが空です。空のチャートを表示します。")
-                axs[idx].clear()
-                axs[idx] = create_empty_chart(fig, channel)
-                continue
-
-            durations = df['duration'].apply(float).tolist()
-            if not durations:
-                print(f"チャンネル {channel} のdurationsが空です。空のチャートを表示します。")
-                axs[idx].clear()
-                axs[idx] = create_empty_chart(fig, channel)
-                continue
-
-            units = df['unit'].tolist()
-            times = [0]
-            for duration, unit in zip(durations, units): # 累積時間を計算
-                times.append(times[-1] + duration * time_factors[unit])
-            # timesの中で、start_timeよりも値が等しいか大きくなる最初のインデックスを取得
-            sub_start_index = next((i for i, t in enumerate(times) if t >= start_time), None)
-            if sub_start_index is None:
-                sub_start_index = 0
-            # timesの中で、end_timeよりも値が等しいか大きくなる最初のインデックスを取得
-            sub_end_index = next((i for i, t in enumerate(times) if t >= end_time), None)
-            if sub_end_index is None:
-                sub_end_index = len(times) - 1
-            # 選択された期間の時間とステートを取得
-            sub_times = times[sub_start_index:sub_end_index]
-            sub_states = states[sub_start_index:sub_end_index]  
-            
-            if not sub_times:
-                print(f"チャンネル {channel} の選択された期間がないです。空のチャートを表示します。")
-                axs[idx].clear()
-                axs[idx] = create_empty_chart(fig, channel)
-                continue
-            # 選択された期間の開始時間がstart_timeと異なる場合は、start_timeを追加
-            if sub_times[0] != start_time:
-                sub_times.insert(0, start_time)
-                sub_states.insert(0, states[sub_start_index - 1])
-            # 選択された期間の終了時間がend_timeと異なる場合は、end_timeを追加
-            if sub_times[-1] != end_time:
-                sub_times.append(end_time)
-                sub_states.append(states[sub_end_index - 1])
+            # 変化点リストからこのチャネルのエッジを取り出し、表示範囲に含まれるものだけを使う
+            edge_ticks, levels = channel_edges(compiled, channel_bits[channel])
+            lo = np.searchsorted(edge_ticks, start_tick, side='right') - 1
+            # 表示範囲にエッジがない（開始と終了が同じ位置など）場合も、start_tickのレベルを1区間として描く
+            hi = max(np.searchsorted(edge_ticks, end_tick, side='left'), lo + 1)
+            # 表示範囲の両端（start_time, end_time）にも点を置く
+            sub_times = [start_time] + (edge_ticks[lo + 1:hi] / TICKS_PER_SECOND).tolist() + [end_time]
+            sub_states = levels[lo:hi].tolist() + [int(levels[hi - 1])]
 
             adjusted_states = [s + idx for s in sub_states] # チャンネルのインデックスをステートに加算
             color = channel_colors[int(channel.split()[-1])] # チャンネルの色を取得
@@ -144,4 +115,8 @@ def create_empty_chart(fig, channel):
     ax.set_yticks([])  # y軸の目盛りを非表示に設定
     ax.set_ylim([-0.1, 1.1])  # y軸の範囲を設定
     ax.set_ylabel("Ch" + channel.split()[-1])  # チャンネル名をy軸のラベルとして設定
-    return ax  # ax を返す
\ No newline at end of file
+    return ax  # ax を返す
+
+def cumulative_ticks(channel):
+    # 各行の開始位置と最終行の終了位置[tick]（1 tick = 1サンプルで描画したときの位置）
+    return np.concatenate(([0], np.cumsum(channel_run_lengths(channel, TICKS_PER_SECOND))))
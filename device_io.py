@@ -0,0 +1,55 @@
+# device_io.py
+# libm2kの呼び出しをすべて1本の専用スレッドで順番に実行するためのエグゼキュータ。
+# Fletのイベントループ（UI）をブロックせず、デバイスへのアクセスはキューに入った順に直列化される。
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class DeviceExecutor:
+    def __init__(self, name: str = "m2k-io"):
+        # ワーカー1本のThreadPoolExecutorは、そのまま先入れ先出しのコマンドキューになる
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._thread_id = None
+        self._lock = threading.Lock()
+        self.pending = 0  # キューに入っている（実行中を含む）コマンド数
+
+    def in_device_thread(self) -> bool:
+        return threading.get_ident() == self._thread_id
+
+    def _submit(self, func, args, kwargs):
+        def task():
+            self._thread_id = threading.get_ident()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.pending -= 1
+        with self._lock:
+            self.pending += 1
+        return self._executor.submit(task)
+
+    def call(self, func, *args, **kwargs):
+        """専用スレッドで実行し、結果を待って返す（専用スレッド内から呼ばれた場合はそのまま実行する）"""
+        if self.in_device_thread():
+            return func(*args, **kwargs)
+        return self._submit(func, args, kwargs).result()
+
+    async def run(self, func, *args, **kwargs):
+        """専用スレッドで実行し、イベントループを止めずに結果を待つ"""
+        if self.in_device_thread():
+            return func(*args, **kwargs)
+        return await asyncio.wrap_future(self._submit(func, args, kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+device_io = DeviceExecutor()  # ADALM2000へのアクセスはすべてこれを経由する
+
+def on_device_thread(method):
+    """同期メソッドを、どのスレッドから呼ばれてもデバイス用スレッドで実行するデコレータ"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return device_io.call(method, *args, **kwargs)
+    return wrapper
@@ -1,18 +1,26 @@
 import csv
 import datetime
 import os
+import secrets
 import shutil
+import time
 import flet as ft
-import pandas as pd
-from typing import Callable, Dict
+from typing import Callable, Dict, Iterator, Optional, Tuple
 import math
-from fractions import Fraction
+from functools import reduce
 from io import StringIO
-import base64
 from pathlib import Path
+import numpy as np
+from pattern_model import ChannelPattern, TICKS_PER_SECOND, ticks_to_samples
+from pattern_render import words_to_bits
+from sample_store import render_to_memmap
+from sample_view import SampleView
 # グローバル変数
 current_dir = Path("../csv_files")  # 相対パスをPathオブジェクトとして保持
 current_file = None
+CSV_CHUNK_SAMPLES = 1 << 16  # データ部分を一度に書き込むサンプル数
+DOWNLOAD_DIR = Path(__file__).resolve().parent / "assets" / "downloads"  # Flet Webサーバーが静的ファイルとして配信する
+MAX_DOWNLOAD_AGE = 3600  # ダウンロード用ファイルを保持する時間 [s]（他のセッションがダウンロード中のファイルを消さないよう、数ではなく経過時間で削除）
 directory_dropdown = None
 filename_dropdown = None
 save_button = None
@@ -84,7 +92,7 @@ def get_directory_hierarchy(base_dir: str, target_dir: str) -> list:
     # サブディレクトリを追加
     if target_path.exists():
         for d in target_path.iterdir():
-            if d.is_dir():
+            if d.is_dir() and not d.name.startswith('.'):  # .buffersなどの内部用ディレクトリは除外
                 # 相対パスのまま追加
                 directories.append(str(d))
     
@@ -104,7 +112,8 @@ def get_directory_hierarchy(base_dir: str, target_dir: str) -> list:
     
     return filtered_directories
 
-def export_csv(page: ft.Page, dataframes: Dict[str, pd.DataFrame], directory: str, filename: str, sample_rate: int):
+def export_csv(page: ft.Page, dataframes: Dict[str, ChannelPattern], directory: str, filename: str, sample_rate: int, mapped=False,
+               window: Optional[Tuple[int, int]] = None):
     # 文字列をPathオブジェクトに変換
     dir_path = Path(directory)
     if not dir_path.exists():
@@ -113,8 +122,8 @@ def export_csv(page: ft.Page, dataframes: Dict[str, pd.DataFrame], directory: st
     
     full_path = dir_path / filename
     
-    # StringIOオブジェクトを取得してファイルに書き込み
-    export_to_csv(dataframes, str(full_path), format_type='scopy', sample_rate=sample_rate)
+    # CSVをファイルに直接書き込み
+    export_to_csv(dataframes, str(full_path), format_type='scopy', sample_rate=sample_rate, mapped=mapped, window=window)
     
     # ファイルのパーミッション設定
     full_path.chmod(0o666)
@@ -124,7 +133,8 @@ def export_csv(page: ft.Page, dataframes: Dict[str, pd.DataFrame], directory: st
     page.add(snackbar)
     close_dialog(page)
 
-def perform_export(directory_textfield: ft.TextField, filename_textfield: ft.TextField, sample_rate_textfield: ft.TextField, page: ft.Page, dataframes: Dict[str, pd.DataFrame], on_export_callback: Callable = None):
+def perform_export(directory_textfield: ft.TextField, filename_textfield: ft.TextField, sample_rate_textfield: ft.TextField, page: ft.Page, dataframes: Dict[str, ChannelPattern], on_export_callback: Callable = None, mapped=False,
+                   window_start_textfield: ft.TextField = None, window_end_textfield: ft.TextField = None):
     global current_dir, current_file
     invalid_chars = set('.<>:"/\\|?*')
     invalid_chars_directory = set(c for c in invalid_chars if c in directory_textfield.value)
@@ -172,20 +182,40 @@ def perform_export(directory_textfield: ft.TextField, filename_textfield: ft.Tex
     except ValueError:
         error_message = "Sample rate must be a valid integer"
         sample_rate_textfield.error_text = error_message
+    # 書き出す時間範囲のバリデーション（空欄はパターンの先頭・末尾）
+    window_times = [None, None]
+    for i, textfield in enumerate((window_start_textfield, window_end_textfield)):
+        if textfield is None:
+            continue
+        textfield.error_text = ""
+        if textfield.value:
+            try:
+                window_times[i] = float(textfield.value)
+                if window_times[i] < 0:
+                    raise ValueError
+            except ValueError:
+                error_message = "Window time must be a non-negative number of seconds"
+                textfield.error_text = error_message
+    if None not in window_times and window_times[0] >= window_times[1]:
+        error_message = "Window end must be after window start"
+        window_end_textfield.error_text = error_message
     
     if error_message:
         snackbar = ft.SnackBar(content=ft.Text(error_message), open=True)
         page.add(snackbar)
     else:
         save_path = current_dir / directory_textfield.value / (filename_textfield.value + ".csv")
-        export_csv(page, dataframes, str(save_path.parent), save_path.name, sample_rate)
+        window = None
+        if window_times != [None, None]:
+            window = time_window_to_samples(sample_rate, *window_times)
+        export_csv(page, dataframes, str(save_path.parent), save_path.name, sample_rate, mapped, window)
         current_file = save_path
         if on_export_callback:
             on_export_callback()
         page.update()
         close_dialog(page)
 
-def export_csv_dialog(page: ft.Page, dataframes: Dict[str, pd.DataFrame], on_export_callback: Callable = None):
+def export_csv_dialog(page: ft.Page, dataframes: Dict[str, ChannelPattern], on_export_callback: Callable = None):
     global directory_dropdown, filename_dropdown, save_button
     base_dir = Path("../csv_files")
     
@@ -206,9 +236,25 @@ def export_csv_dialog(page: ft.Page, dataframes: Dict[str, pd.DataFrame], on_exp
         hint_text="e.g., 1000000", 
         value=str(calculate_optimal_sample_rate(dataframes))
     )
+    mapped_checkbox = ft.Checkbox(
+        label="Disk-backed buffer (for very long patterns)",
+        value=False
+    )
+    # 書き出す時間範囲（空欄の場合はパターン全体）
+    window_start_textfield = ft.TextField(
+        label="Window start (s)",
+        hint_text="blank = from the beginning",
+        expand=True
+    )
+    window_end_textfield = ft.TextField(
+        label="Window end (s)",
+        hint_text="blank = to the end",
+        expand=True
+    )
     save_button = ft.ElevatedButton(
         text="Export", 
-        on_click=lambda e: perform_export(directory_textfield, filename_textfield, sample_rate_textfield, page, dataframes, on_export_callback)
+        on_click=lambda e: perform_export(directory_textfield, filename_textfield, sample_rate_textfield, page, dataframes, on_export_callback, mapped_checkbox.value,
+                                          window_start_textfield, window_end_textfield)
     )
     
     # ディレクトリ階層を取得
@@ -244,7 +290,9 @@ def export_csv_dialog(page: ft.Page, dataframes: Dict[str, pd.DataFrame], on_exp
             new_directory_button, 
             directory_textfield, 
             filename_textfield, 
-            sample_rate_textfield
+            sample_rate_textfield,
+            ft.Row([window_start_textfield, window_end_textfield]),
+            mapped_checkbox
         ], spacing=10),
         actions=[
             save_button,
@@ -398,160 +446,158 @@ def delete_csv_dialog(page: ft.Page):
     update_filename_options()
     page.update()
 
-def gcd(a, b):
-    while b:
-        a, b = b, a % b
-    return a
-
-def lcm(a, b):
-    return abs(a * b) // math.gcd(a, b)
-
-def calculate_optimal_sample_rate(dataframes: Dict[str, pd.DataFrame]):
-    time_factors = {'sec.': 1, 'msec.': 1e-3, 'microsec.': 1e-6}
-    all_durations = []
-    
-    for df in dataframes.values():
-        for duration, unit in zip(df['duration'], df['unit']):
-            all_durations.append(Fraction(duration * time_factors[unit]).limit_denominator())
-    
-    # 重複を削除し、ソートする
-    unique_durations = sorted(set(all_durations))
-    
-    # 最大公約数を計算
-    gcd_value = unique_durations[0]
-    for duration in unique_durations[1:]:
-        gcd_value = Fraction(gcd(gcd_value.numerator, duration.numerator), 
-                             lcm(gcd_value.denominator, duration.denominator))
+def calculate_optimal_sample_rate(dataframes: Dict[str, ChannelPattern]):
+    # 全チャネルのduration（整数tick）の最大公約数を計算（チャネルごとの値は変更されるまでキャッシュされる）
+    gcd_ticks = reduce(math.gcd, (channel.tick_gcd() for channel in dataframes.values()), 0)
+    if gcd_ticks == 0: # durationが存在しない場合
+        return 1000000
     
     # サンプリングレートを計算（最大1,000,000 Hz）
-    optimal_rate = int(min(1 / gcd_value, 1000000))
+    optimal_rate = min(TICKS_PER_SECOND // gcd_ticks, 1000000)
     return max(optimal_rate, 1)  # 最小値を1に設定
 
-def convert_to_seconds(duration, unit):
-    if unit == 'sec.':
-        return duration
-    elif unit == 'msec.':
-        return duration / 1000
-    elif unit == 'microsec.':
-        return duration / 1000000
-    else:
-        raise ValueError(f"Unknown unit: {unit}")
+def time_window_to_samples(sample_rate: int, start_seconds: Optional[float] = None, end_seconds: Optional[float] = None) -> Tuple[int, Optional[int]]:
+    """時間範囲[s]をサンプル範囲 (start, stop) に換算する（時刻は1 ns単位に丸める。end省略時のstopはNone）"""
+    def to_sample(seconds):
+        return int(ticks_to_samples(round(seconds * TICKS_PER_SECOND), sample_rate))
+    start = to_sample(start_seconds) if start_seconds is not None else 0
+    stop = to_sample(end_seconds) if end_seconds is not None else None
+    return start, stop
 
-def calculate_channel_samples(df, sample_rate):
-    return sum(int(convert_to_seconds(row['duration'], row['unit']) * sample_rate) for _, row in df.iterrows())
-
-def export_to_csv(dataframes: Dict[str, pd.DataFrame], file_path: str, format_type='scopy', sample_rate=1000000):
-    # StringIOオブジェクトを取得
-    csv_content = export_to_string_io(dataframes, format_type, sample_rate)
-    
-    # ファイルに書き込み
+def export_to_csv(dataframes: Dict[str, ChannelPattern], file_path: str, format_type='scopy', sample_rate=1000000, mapped=False,
+                  window: Optional[Tuple[int, Optional[int]]] = None):
     file_path = Path(file_path)
-    with open(file_path, 'w', newline='') as csvfile:
-        csvfile.write(csv_content.getvalue())
+    if window is not None:
+        # 変化点リストから範囲内だけを展開しながら、直接ファイルへ書き込む
+        view = SampleView.from_pattern(dataframes, sample_rate)
+        with open(file_path, 'w', newline='') as csvfile:
+            write_csv(csvfile, view, view.sample_rate, len(dataframes), format_type, window)
+    elif mapped:
+        # メモリマップしたサンプルワード列から、チャンクごとに直接ファイルへ書き込む
+        rendered = render_to_memmap(dataframes, sample_rate)
+        with open(file_path, 'w', newline='') as csvfile:
+            write_csv(csvfile, rendered.words, rendered.sample_rate, len(dataframes), format_type)
+    else:
+        # 変化点リストからチャンクごとに展開しながらファイルへ書き込む（メモリ使用量はパターンの長さによらない）
+        view = SampleView.from_pattern(dataframes, sample_rate)
+        with open(file_path, 'w', newline='') as csvfile:
+            write_csv(csvfile, view, view.sample_rate, len(dataframes), format_type)
     
     # csvファイルに666パーミッションを設定
     file_path.chmod(0o666)
 
     print(f"Data exported to {file_path} in {format_type} format.")
 
-def export_to_string_io(dataframes: Dict[str, pd.DataFrame], format_type='scopy', sample_rate=None, cyclic=False):
-    if sample_rate is None:
-        sample_rate = calculate_optimal_sample_rate(dataframes)
-    
-    csv_content = StringIO()
-    writer = csv.writer(csv_content)
-    # サンプル数を計算
-    original_total_samples = max(calculate_channel_samples(df, sample_rate) for df in dataframes.values())
-    
-    # cyclicがTrueの場合はサンプル数が４の倍数になるように調整
-    if cyclic == True: # cyclicがTrueの場合
-        if original_total_samples % 4 == 0: # original_total_samplesが４の倍数
-            pass # 何もしない
-        elif original_total_samples % 2 == 0: # original_total_samplesが偶数の場合
-            original_total_samples *= 2 # ２をかけて４の倍数とする
-            sample_rate *= 2
-        else: # original_total_samplesが奇数の場合
-            original_total_samples *= 4 # ４をかけて４の倍数とする
-            sample_rate *= 4
+def write_csv(csvfile, samples, sample_rate: int, num_channels: int, format_type='scopy',
+              window: Optional[Tuple[int, Optional[int]]] = None):
+    """iter_csv_chunks のチャンクを順にcsvfileへ書き込む"""
+    for chunk in iter_csv_chunks(samples, sample_rate, num_channels, format_type, window):
+        csvfile.write(chunk)
 
-    # ADALM2000の制約に合わせてtotal_samplesを調整（digital.pyでテストの結果、4以上の４の倍数が適切）
-    #total_samples = max(16, ((original_total_samples + 3) // 4) * 4) # 16以上の4の倍数
-    #total_samples = max(16, ((original_total_samples + 15) // 16) * 16) # 16以上の16の倍数
-    #total_samples = max(8, ((original_total_samples + 3) // 4) * 4) # ８以上の４の倍数
-    total_samples = max(4, ((original_total_samples + 3) // 4) * 4) # 4以上の４の倍数
-    
-    # original_total_samplesが既に4の倍数の場合、4サンプル追加（ゼロ埋め用領域）
-    #この処理はすべてのチャネルのdataframeの末尾のstateが'low'になっていない場合に実行する。
-    # 空のチャネルは'low'とみなす。
-    # cyclicがFalseの場合のみ実行する。
-    if total_samples == original_total_samples and cyclic == False and any(df['state'].iloc[-1] != 'low' if not df.empty else False for df in dataframes.values()):
-    #if total_samples == original_total_samples and all(df['state'].iloc[-1] != 'low' for df in dataframes.values() if not df.empty): # 空のチャネルの扱いが不適切
-    #if total_samples == original_total_samples: # 元の条件式
-        total_samples += 4
-    
+def iter_csv_chunks(samples, sample_rate: int, num_channels: int, format_type='scopy',
+                    window: Optional[Tuple[int, Optional[int]]] = None) -> Iterator[str]:
+    """
+    samples（ワード列のndarray・memmap・SampleView）のうち、window = (start, stop) のサンプル範囲のCSVを
+    メタデータ・ヘッダー、CSV_CHUNK_SAMPLES行ごとのデータの順に文字列として生成する。
+    windowを指定した場合、データ部分のSample列は範囲の先頭を0として数え、範囲はメタデータに記録する。
+    """
+    total_samples = len(samples)
+    start, stop = window if window is not None else (0, None)
+    start = min(max(start, 0), total_samples)
+    stop = total_samples if stop is None else min(max(stop, start), total_samples)
+
+    header_content = StringIO()
+    writer = csv.writer(header_content)
     if format_type == 'scopy':
         # メタデータ（セミコロンで始まる行）
         writer.writerow([';Scopy version', 'your_version_here'])
         writer.writerow([';Exported on', datetime.datetime.now().strftime('%a %b %d/%m/%Y')])
         writer.writerow([';Device', 'M2K'])
-        writer.writerow([';Nr of samples', str(total_samples)])  # 調整後のtotal_samplesを使用
+        writer.writerow([';Nr of samples', str(stop - start)])  # 調整後のtotal_samples（範囲指定時は範囲内の数）を使用
         writer.writerow([';Sample rate', str(sample_rate)])
         writer.writerow([';Tool', 'Logic Analyzer'])
-        writer.writerow([';Additional Information', ''])
+        additional_information = ''
+        if window is not None:
+            additional_information = (f'Window: samples {start}-{stop} of {total_samples} '
+                                      f'({start / sample_rate:.9g} s - {stop / sample_rate:.9g} s)')
+        writer.writerow([';Additional Information', additional_information])
         
         # チャンネルヘッダー
-        header = ['Sample'] + [f'Channel {i}' for i in range(len(dataframes))]
+        header = ['Sample'] + [f'Channel {i}' for i in range(num_channels)]
         writer.writerow(header)
+        yield header_content.getvalue()
     
-    channel_states = {}
-    for channel, df in dataframes.items():
-        channel_states[channel] = {
-            'iterator': df.iterrows(),
-            'current_state': 0,
-            'remaining_samples': 0
-        }
-    # dataframesを元にデータ部分を書き込み
-    for sample_index in range(original_total_samples):
-        row = [sample_index] if format_type == 'scopy' else []
-        for channel in dataframes.keys():
-            state = channel_states[channel]
-            if state['remaining_samples'] == 0:
-                try:
-                    _, current_row = next(state['iterator'])
-                    state['current_state'] = 1 if current_row['state'] == 'high' else 0
-                    duration_seconds = convert_to_seconds(current_row['duration'], current_row['unit'])
-                    state['remaining_samples'] = int(duration_seconds * sample_rate)
-                except StopIteration:
-                    pass  # Keep the last state if we've run out of data
-            
-            row.append(state['current_state'])
-            state['remaining_samples'] = max(0, state['remaining_samples'] - 1)
+    # ワード列をチャンクごとに文字列に変換してデータ部分を生成（memmapやビューの場合も全体を読み込まない）
+    for chunk_start in range(start, stop, CSV_CHUNK_SAMPLES):
+        words = np.asarray(samples[chunk_start:min(chunk_start + CSV_CHUNK_SAMPLES, stop)])
+        first_index = chunk_start - start if format_type == 'scopy' else None
+        yield format_csv_rows(words, num_channels, first_index)
 
-        writer.writerow(row)
+def format_csv_rows(words: np.ndarray, num_channels: int, first_index: Optional[int] = None) -> str:
+    """
+    ワード列を、csv.writer.writerows で各サンプルの [Sample列,] ビット... を書いたのと同じ文字列にする。
+    1行の各文字を uint8 配列の列として一度に埋めるため、行ごとのPython処理がない。
+    """
+    count = len(words)
+    bits = words_to_bits(words, num_channels)
+    # ビット部分 "b0,b1,...,bn-1" の文字
+    body = np.full((count, max(2 * num_channels - 1, 0)), ord(','), dtype=np.uint8)
+    body[:, 0::2] = bits + ord('0')
 
-    # ゼロ埋めを追加
-    ####### secCycleをTrueにした場合は実行しない（ToDo）
-    for sample_index in range(original_total_samples, total_samples):
-        row = [sample_index] if format_type == 'scopy' else []
-        row.extend([0] * len(dataframes))
-        writer.writerow(row)
+    if first_index is None:
+        segments = [(0, count, 0)]
+    else:
+        # Sample列は桁数が同じ行ごとに固定幅で埋める（行番号は昇順なので桁数ごとに連続する）
+        segments = []
+        segment_start = 0
+        while segment_start < count:
+            width = len(str(first_index + segment_start))
+            segment_stop = min(count, 10 ** width - first_index)
+            segments.append((segment_start, segment_stop, width))
+            segment_start = segment_stop
 
-    csv_content.seek(0)
-    return csv_content
+    pieces = []
+    for segment_start, segment_stop, width in segments:
+        separator = 1 if width and num_channels else 0
+        rows = np.empty((segment_stop - segment_start, width + separator + body.shape[1] + 2), dtype=np.uint8)
+        if width:
+            indices = np.arange(first_index + segment_start, first_index + segment_stop, dtype=np.int64)
+            for position in range(width):
+                rows[:, width - 1 - position] = indices // 10 ** position % 10 + ord('0')
+        if separator:
+            rows[:, width] = ord(',')
+        rows[:, width + separator:-2] = body[segment_start:segment_stop]
+        rows[:, -2:] = (ord('\r'), ord('\n'))  # csv.writerの既定の行末
+        pieces.append(rows.tobytes())
+    return b''.join(pieces).decode('ascii')
 
 # 使用例
 # export_to_csv(dataframes, 'output_simple.csv', format_type='simple', sample_rate=1000000)
 # export_to_csv(dataframes, 'output_scopy.csv', format_type='scopy', sample_rate=1000000)
+def prune_download_files(keep: Path):
+    expired = time.time() - MAX_DOWNLOAD_AGE
+    for f in DOWNLOAD_DIR.glob("pattern_*"):
+        try:
+            if f != keep and f.stat().st_mtime < expired:
+                f.unlink()
+        except OSError as e:
+            print(f"Error deleting download file {f}: {e}")
+
 def download_csv(e, dataframes):
     print("download_csv function called")
     # 最適なサンプルレートを計算
     optimal_sample_rate = calculate_optimal_sample_rate(dataframes)
     print(f"Optimal sample rate: {optimal_sample_rate}")
-    # CSVデータを生成
-    csv_content = export_to_string_io(dataframes, format_type='scopy', sample_rate=optimal_sample_rate)
-    # Base64エンコードしたCSVデータを作成
-    csv_base64 = base64.b64encode(csv_content.getvalue().encode()).decode()
-    # ダウンロードリンクを生成
-    download_link = f"data:text/csv;base64,{csv_base64}"
-    # ダウンロードリンクを開く
+    # CSVをチャンクごとにassets配下のファイルへ書き出す（data URLのようにメモリ上に全体を持たない）
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    # assets配下は同じサーバーの全クライアントから取得できるため、ファイル名は推測できないランダムな文字列にする
+    file_path = DOWNLOAD_DIR / f"pattern_{secrets.token_urlsafe(16)}.csv"
+    temp_path = file_path.with_suffix(".tmp")
+    view = SampleView.from_pattern(dataframes, optimal_sample_rate)
+    with open(temp_path, 'w', newline='') as csvfile:
+        write_csv(csvfile, view, view.sample_rate, len(dataframes), 'scopy')
+    os.replace(temp_path, file_path)
+    prune_download_files(file_path)
+    # Webモードではassets_dirを配信しているFletのWebサーバーからファイルとしてダウンロードさせる
+    download_link = f"/downloads/{file_path.name}" if e.page.web else file_path.as_uri()
     e.page.launch_url(download_link)
\ No newline at end of file
@@ -3,6 +3,7 @@ import pickle
 import shutil
 import flet as ft
 from pathlib import Path
+from pattern_model import ensure_channel_patterns
 
 # グローバル変数の宣言
 current_dir = Path("../pkl_files")  # 相対パスをPathオブジェクトとして保持
@@ -261,6 +262,8 @@ def load_dataframes(page, file_path, inputs_row, table_chart_row, channel_dropdo
         file_path = Path(file_path)
         with open(file_path, 'rb') as f:
             loaded_dataframes = pickle.load(f)
+        # 旧形式（DataFrame）で保存されたファイルはChannelPatternに変換する
+        loaded_dataframes = ensure_channel_patterns(loaded_dataframes)
         
         inputs_row.visible = True
         table_chart_row.visible = True
@@ -0,0 +1,18 @@
+# m2k_backend.py
+# M2KDigitalが使うデバイスバックエンドの切り替え。
+# バックエンドは、libm2kのうちこのアプリが使う部分と同じ名前を持つモジュール：
+#   m2kOpen(uri) -> コンテキスト（getDigital()でデジタル部を返す）、contextClose(ctx)、
+#   DIO_INPUT / DIO_OUTPUT / LOW / HIGH
+# 'libm2k' は実機（libm2k）、'sim' はプロセス内のシミュレータ（m2k_simulator）。
+
+BACKENDS = ('libm2k', 'sim')
+
+def load_backend(name: str):
+    """nameのバックエンドを読み込み、libm2k互換のモジュールを返す"""
+    if name == 'libm2k':
+        import libm2k
+        return libm2k
+    if name == 'sim':
+        import m2k_simulator
+        return m2k_simulator
+    raise ValueError(f"Unknown M2K backend: {name} (choose from {', '.join(BACKENDS)})")
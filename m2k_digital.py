@@ -1,16 +1,35 @@
 # m2k_digital.py
 
-import libm2k
 import pandas as pd
-from typing import Dict, List, TYPE_CHECKING
-from export_csv import export_to_string_io, calculate_optimal_sample_rate
-import csv
-from io import StringIO
+from typing import Dict, Iterator, List, NamedTuple, Optional, TYPE_CHECKING
+from export_csv import calculate_optimal_sample_rate
+from pattern_render import render_pattern, plane_cache, iter_word_chunks, transition_stats, RenderedPattern
+from pattern_period import split_periodic, split_cyclic_period, PeriodicSplit
+from render_cache import render_cache
+from repeat_scheduler import RepeatScheduler
+from device_io import device_io, on_device_thread
+from m2k_backend import load_backend
+from sample_store import render_to_memmap, iter_buffer_chunks
+from rate_planner import plan_sample_rate, format_seconds, format_bytes
+import numpy as np
 import flet as ft
 import asyncio
 import time
 from asyncio import Event
 import json
+import sys
+import array
+
+try:
+    import resource  # Windowsでは利用できない
+except ImportError:
+    resource = None
+
+try:
+    libm2k = load_backend('libm2k')  # set_backendで切り替えられる（libm2kと同じAPIを持つモジュール）
+except ImportError:
+    libm2k = None  # --m2k-backend sim で起動する場合はlibm2kがなくてもよい
+m2k_backend_name = 'libm2k'
 
 # グローバル変数
 enabled_channels = []
@@ -18,12 +37,42 @@ global_buffer = None
 global_sample_rate = None
 global_repeat_count = 1
 global_interval_seconds = 0
+global_interval_ms = 0  # 秒未満のインターバル [ms]（global_interval_secondsに加算される）
 global_repeat_enabled = False
 global_m2k = None
+m2k_session = None  # play_dialogとchannel_control_dialogで共有するADALM2000への接続
 global_cyclic_enabled = False
 global_cycle_count = 1
 global_infinite_cycle_enabled = False
 global_m2k_ip = None
+global_error_tolerance_ns = 100  # サンプルレート計画で許容するタイミング誤差 [ns]
+global_memory_cap_mb = 256  # サンプルレート計画で許容するバッファサイズ [MB]
+global_mapped_enabled = False  # サンプルワード列をファイルに描画し、メモリマップから出力する
+global_streaming_enabled = False  # 非cyclic出力でパターンをチャンクごとに描画しながら転送する
+global_periodic_split_enabled = False  # 実験的：非cyclic出力で周期的な末尾を1周期だけ転送する（切り替えの隙間あり、停止時刻はおおよそ）
+global_stream_chunk_samples = 1 << 20  # ストリーミング出力の1回のpushのサンプル数（4の倍数）
+global_kernel_buffers = 4  # ストリーミング出力でデバイス側に積んでおくカーネルバッファ数
+global_stream_stats = None  # 直近のストリーミング出力の統計（チャンク数・アンダーラン回数）
+global_device_stats = None  # 直近の再生でのデバイス呼び出し回数（チャネル設定・合計・省略した設定）
+
+def peak_rss_bytes():
+    # プロセス起動からの最大常駐メモリ（この再生だけの値ではない。取得できない環境ではNone）
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linuxの単位はKB
+
+def set_backend(name: str):
+    """デバイスバックエンドを切り替える（'libm2k' または 'sim'）。開いている接続は閉じる"""
+    global libm2k, m2k_backend_name, m2k_session, global_m2k
+    backend = load_backend(name)
+    if m2k_session is not None:
+        m2k_session.disconnect()
+        m2k_session = None
+    global_m2k = None
+    libm2k = backend
+    m2k_backend_name = name
+    print(f"M2K backend: {name}")
 
 def load_containers_info(): # app_info.jsonからIPアドレスを読み込む
     global global_m2k_ip
@@ -35,36 +84,164 @@ def load_containers_info(): # app_info.jsonからIPアドレスを読み込む
         print(f"Error loading settings: {e}")
         global_m2k_ip = "ip:192.168.2.1"  # デフォルト値
 
+class CountingDigital:
+    """libm2kのデジタル部をラップし、デバイスの呼び出し（IIOコンテキスト越しの往復）を数える"""
+    def __init__(self, dig):
+        self._dig = dig
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._dig, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+class ChannelConfig:
+    """デバイスに最後に設定した内容（Noneは不明）。setup_channelsは差分だけを送る"""
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        # リセット・再接続の後は設定内容が分からないので、次回はすべて送り直す
+        self.sample_rate = None
+        self.directions = [None] * 16
+        self.enabled = [None] * 16
+        self.raw = [None] * 16
+
 class M2KDigital:
+    # libm2kの呼び出しはすべてdevice_ioの専用スレッドで行う（同期メソッドは@on_device_thread、
+    # asyncメソッドはdevice_io.runを経由）。例外はcancel()で、実行中のpushを別スレッドから中断する。
     def __init__(self, uri="ip:192.168.2.1"):
+        if libm2k is None:
+            raise ImportError("libm2k is not installed (use --m2k-backend sim to run without a device)")
         try:
             self.ctx = libm2k.m2kOpen(uri)
             if self.ctx is None:
                 raise ConnectionError(f"No ADALM2000 device available/connected at {uri}")
-            self.dig = self.ctx.getDigital()
+            self.dig = CountingDigital(self.ctx.getDigital())
             self.dig.reset()
+            self.config = ChannelConfig()
+            self.last_push_seconds = 0.0
         except Exception as e:
             print(f"Error initializing M2KDigital: {str(e)}")
             raise
 
+    @on_device_thread
     def setup_channels(self, sample_rate: int):
         global enabled_channels, global_sample_rate
         
         if not isinstance(sample_rate, int) or sample_rate <= 0:
             raise ValueError(f"Invalid sample rate: {sample_rate}")
         
-        self.dig.setSampleRateOut(sample_rate)
+        # 前回設定した内容と同じ項目は送らない（各呼び出しがデバイスとの往復になるため）
+        config = self.config
+        skipped = 0
+        if config.sample_rate != sample_rate:
+            self.dig.setSampleRateOut(sample_rate)
+            config.sample_rate = sample_rate
+        else:
+            skipped += 1
         global_sample_rate = sample_rate
 
-        for i in range(16):  # ADALM2000 has 16 digital channels
-            if i in enabled_channels:
-                self.dig.setDirection(i, libm2k.DIO_OUTPUT)
+        directions = [libm2k.DIO_OUTPUT if i in enabled_channels else libm2k.DIO_INPUT
+                      for i in range(16)]  # ADALM2000 has 16 digital channels
+        skipped += self._apply_directions(directions)
+
+        for i in enabled_channels:
+            if config.enabled[i] is not True:
                 self.dig.enableChannel(i, True)
+                config.enabled[i] = True
+            else:
+                skipped += 1
+            if config.raw[i] != libm2k.LOW:
                 self.dig.setValueRaw(i, libm2k.LOW)
+                config.raw[i] = libm2k.LOW
             else:
-                self.dig.setDirection(i, libm2k.DIO_INPUT)
+                skipped += 1
+        return skipped
+
+    def _apply_directions(self, directions: List[Optional[int]]) -> int:
+        # 方向が変わるチャネルだけを設定し、変わらなかったチャネル数を返す（Noneのチャネルは触らない）
+        config = self.config
+        changed = [i for i in range(16) if directions[i] is not None and config.directions[i] != directions[i]]
+        if len(changed) > 1 and None not in directions:
+            # 全チャネルの方向が決まっていれば、ビットマスク（1=出力）で一度に設定する
+            self.dig.setDirection(sum(1 << i for i in range(16) if directions[i] == libm2k.DIO_OUTPUT))
+        else:
+            for i in changed:
+                self.dig.setDirection(i, directions[i])
+        for i in changed:
+            config.directions[i] = directions[i]
+        return 16 - len(changed)
+
+    @on_device_thread
+    def read_values(self) -> int:
+        """全チャネルのレベルを1回のデバイス処理で読み、ビットマスク（1=HIGH）で返す"""
+        values = 0
+        for channel in range(16):
+            if self.dig.getValueRaw(channel) == libm2k.HIGH:
+                values |= 1 << channel
+        return values
+
+    @on_device_thread
+    def write_values(self, mask: int, values: int, output_mask: Optional[int] = None):
+        """
+        maskのチャネルにvaluesのビット（1=HIGH）のレベルを設定する（LOWのチャネルは無効にする）。
+        output_maskのチャネル（省略時はmaskと同じ）は出力に切り替え、それ以外の方向は変更しない。
+        前回と同じ設定は送らない。
+        """
+        config = self.config
+        if output_mask is None:
+            output_mask = mask
+        channels = [channel for channel in range(16) if (mask >> channel) & 1]
+        if output_mask:
+            directions = [libm2k.DIO_OUTPUT if (output_mask >> i) & 1 else config.directions[i] for i in range(16)]
+            self._apply_directions(directions)
+        for channel in channels:
+            high = bool((values >> channel) & 1)
+            if config.enabled[channel] != high:
+                self.dig.enableChannel(channel, high)
+                config.enabled[channel] = high
+            level = libm2k.HIGH if high else libm2k.LOW
+            if config.raw[channel] != level:
+                self.dig.setValueRaw(channel, level)
+                config.raw[channel] = level
+
+    @on_device_thread
+    def push(self, buffer: np.ndarray):
+        # libm2kのpushはPythonのシーケンスしか受け取らない。tolist()はサンプルごとにintオブジェクトを作る（28 B以上/サンプル）ため、
+        # 2 B/サンプルのままintを返すシーケンスであるarray.array('H')にコピーして渡す
+        start = time.perf_counter()
+        words = array.array('H')
+        words.frombytes(memoryview(np.ascontiguousarray(buffer, dtype=np.uint16)).cast('B'))
+        self.dig.push(words)
+        self.last_push_seconds = time.perf_counter() - start  # 転送スループットの確認用
+
+    def cancel(self):
+        """実行中のpushをすぐに中断させる（専用スレッドで処理中のpushを止めるため、キューを経由しない）"""
+        try:
+            self.dig.cancelBufferOut()
+        except Exception as e:
+            print(f"Error cancelling buffer output: {e}")
+
+    async def _push(self, buffer: np.ndarray, stop_event: asyncio.Event) -> bool:
+        # pushがStop（cancel）で中断された場合はFalseを返す
+        try:
+            await device_io.run(self.push, buffer)
+            if self.last_push_seconds > 0:
+                print(f"Pushed {format_bytes(buffer.size * 2)} in {self.last_push_seconds * 1000:.1f} ms "
+                      f"({buffer.size * 2 / self.last_push_seconds / 1e6:.1f} MB/s)")
+            return True
+        except Exception:
+            if stop_event.is_set():
+                print("Push cancelled by stop request")
+                return False
+            raise
 
-    async def send_pattern(self, buffer: List[int], stop_event: asyncio.Event):
+    async def send_pattern(self, buffer: np.ndarray, stop_event: asyncio.Event, period_samples: int = None):
         global global_sample_rate, global_cyclic_enabled, global_cycle_count, global_infinite_cycle_enabled
         
         if not isinstance(global_sample_rate, int) or global_sample_rate <= 0:
@@ -72,55 +249,146 @@ class M2KDigital:
 
         sleep_duration = len(buffer) / global_sample_rate
         if global_cyclic_enabled and not global_infinite_cycle_enabled:
-            sleep_duration *= global_cycle_count
+            # バッファに複数周期が並んでいる場合（unroll）も、パターン1周期を単位にサイクル数を数える
+            sleep_duration = (period_samples or len(buffer)) * global_cycle_count / global_sample_rate
 
-        elapsed_time = 0
-        self.dig.setCyclic(global_cyclic_enabled)
-        count_step = 0.1
+        await device_io.run(self.dig.setCyclic, global_cyclic_enabled)
         start_time = time.time()
-        self.dig.push(buffer)
+        if await self._push(buffer, stop_event):
+            # サンプル数とレートから求めた終了時刻まで待つ（無限サイクルの場合はStopまで待つ）
+            deadline = None if global_cyclic_enabled and global_infinite_cycle_enabled else time.monotonic() + sleep_duration
+            await self._wait_until(deadline, stop_event)
 
-        while True:  # 無限ループに変更
-            if stop_event.is_set():
-                print("Pattern output interrupted")
-                break
-            await asyncio.sleep(count_step)
-            elapsed_time += count_step
-            
-            if not global_infinite_cycle_enabled and elapsed_time >= sleep_duration:
-                break  # 無限サイクルでない場合のみ、指定時間経過後にループを抜ける
-
-        self.dig.stopBufferOut()
+        await device_io.run(self.dig.stopBufferOut)
         
         total_time = time.time() - start_time
         print(f"Total send_pattern time: {total_time:.6f} seconds")
 
-    def _csv_to_buffer(self, csv_content: StringIO) -> tuple:
-        csv_content.seek(0)  # ファイルポインタを先頭に戻す
-        reader = csv.reader(csv_content)
-    
-        buffer = []
-        sample_rate = None
-        total_samples = None
-    
-        for i, row in enumerate(reader):
-            if i == 3:  # 4行目: サンプル数
-                total_samples = int(row[1])
-            elif i == 4:  # 5行目: サンプルレート
-                sample_rate = int(row[1])
-            elif i >= 8:  # 9行目降: データ
-                # 最初の列（サンププし、残りを2進数に変換
-                state = sum(int(val) << i for i, val in enumerate(row[1:]))
-                buffer.append(state)
-    
-        if sample_rate is None or total_samples is None:
-            raise ValueError("Sample rate or total samples not found in CSV data")
-    
-        if len(buffer) != total_samples:
-            raise ValueError(f"Expected {total_samples} samples, but got {len(buffer)}")
-    
-        return buffer, sample_rate
+    async def send_periodic_pattern(self, split: PeriodicSplit, stop_event: asyncio.Event):
+        """
+        cyclic出力（先頭部分なし）：パターン全体がk周期の繰り返しなので、1周期分のバッファをsend_patternで出力する。
+        サイクル数はパターン1周期（cyclic_samples）を単位に数えるため、デバイス上では周期をk倍の回数繰り返す。
+        非cyclic出力（実験的）：先頭部分を一度だけ出力した後、1周期分のバッファをcyclicで繰り返し、サイクル数から求めた時刻で停止する。
+        先頭部分と周期部分の切り替えにはpushの時間だけ隙間ができ、停止もソフトウェアのタイマーで行うため、
+        パターン末尾（ゼロ埋め部分を含む）はサンプル単位では再現されない。
+        """
+        global global_sample_rate, global_cyclic_enabled
+
+        if global_cyclic_enabled:
+            print(f"Cyclic period: {split.cyclic_samples // split.period_samples} periods of {split.period_samples} samples per cycle")
+            await self.send_pattern(split.period, stop_event, split.cyclic_samples)
+            return
+
+        if not isinstance(global_sample_rate, int) or global_sample_rate <= 0:
+            raise ValueError(f"Invalid global sample rate: {global_sample_rate}")
+
+        start_time = time.time()
+        if len(split.prefix):
+            await device_io.run(self.dig.setCyclic, False)
+            if not (await self._push(split.prefix, stop_event) and
+                    await self._wait_until(time.monotonic() + len(split.prefix) / global_sample_rate, stop_event)):
+                await device_io.run(self.dig.stopBufferOut)
+                return
+
+        await device_io.run(self.dig.setCyclic, True)
+        if await self._push(split.period, stop_event):
+            # 周期部分を出力し終える時刻（パターン末尾）で停止する
+            cycles = split.cyclic_samples / split.period_samples
+            print(f"Periodic output: {cycles:.3f} cycles of {split.period_samples} samples")
+            await self._wait_until(time.monotonic() + split.cyclic_samples / global_sample_rate, stop_event)
+        await device_io.run(self.dig.stopBufferOut)
 
+        total_time = time.time() - start_time
+        print(f"Total send_periodic_pattern time: {total_time:.6f} seconds")
+
+    async def send_stream(self, chunks, chunk_samples: int, stop_event: asyncio.Event, kernel_buffers: int = 4):
+        """
+        チャンクを順に描画しながら非cyclicで連続してpushする。pushはカーネルバッファが空くまでブロックするため
+        デバイス用スレッドで行い、その間に次のチャンクを描画する。デバイス側のデータが尽きた時点でpushできたものをアンダーランとして数える。
+        """
+        global global_sample_rate
+
+        if not isinstance(global_sample_rate, int) or global_sample_rate <= 0:
+            raise ValueError(f"Invalid global sample rate: {global_sample_rate}")
+
+        chunk_duration = chunk_samples / global_sample_rate
+        stats = {"chunks": 0, "underruns": 0, "underrun_time": 0.0}
+        await device_io.run(self.dig.setCyclic, False)
+        await device_io.run(self.dig.setKernelBuffersCountOut, kernel_buffers)
+        start_time = time.time()
+        queued_until = None  # デバイスに積んだデータを出力し終える時刻（monotonic）
+        pending = None
+        try:
+            for chunk in chunks:
+                if len(chunk) < chunk_samples:
+                    # 最後のチャンクはゼロ埋め領域を延ばして同じ大きさにする（カーネルバッファの大きさは固定）
+                    chunk = np.concatenate((chunk, np.zeros(chunk_samples - len(chunk), dtype=np.uint16)))
+                if pending:
+                    pushed_at, pending = await self._await_push(pending, stop_event), None
+                    if pushed_at is None:
+                        break
+                    queued_until = self._account_push(pushed_at, queued_until, chunk_duration, stats)
+                if stop_event.is_set():
+                    print("Pattern output interrupted")
+                    break
+                pending = asyncio.create_task(device_io.run(self._timed_push, chunk))
+            if pending:
+                pushed_at, pending = await self._await_push(pending, stop_event), None
+                if pushed_at is not None:
+                    queued_until = self._account_push(pushed_at, queued_until, chunk_duration, stats)
+            if queued_until is not None:
+                await self._wait_until(queued_until, stop_event)
+        finally:
+            if pending:
+                await asyncio.gather(pending, return_exceptions=True)
+            await device_io.run(self.dig.stopBufferOut)
+
+        total_time = time.time() - start_time
+        print(f"Total send_stream time: {total_time:.6f} seconds, stats: {stats}")
+        return stats
+
+    def _timed_push(self, chunk: np.ndarray) -> float:
+        self.push(chunk)
+        return time.monotonic()
+
+    async def _await_push(self, pending: asyncio.Task, stop_event: asyncio.Event) -> Optional[float]:
+        # pushの完了時刻を返す（Stopで中断された場合はNone）
+        try:
+            return await pending
+        except Exception:
+            if stop_event.is_set():
+                print("Push cancelled by stop request")
+                return None
+            raise
+
+    def _account_push(self, pushed_at: float, queued_until, chunk_duration: float, stats: dict) -> float:
+        # デバイスに積んだデータが尽きた後にpushが終わった場合はアンダーラン（出力が途切れた）
+        if queued_until is not None and pushed_at > queued_until:
+            stats["underruns"] += 1
+            stats["underrun_time"] += pushed_at - queued_until
+        stats["chunks"] += 1
+        return max(queued_until or pushed_at, pushed_at) + chunk_duration
+
+    async def _wait_until(self, deadline: Optional[float], stop_event: asyncio.Event) -> bool:
+        """
+        monotonicの時刻deadlineまで待機する（Noneの場合はStopまで待つ）。
+        stop_eventがセットされるとその時点で戻り、Falseを返す。
+        """
+        try:
+            if deadline is None:
+                await stop_event.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining > 0 and not stop_event.is_set():
+                    await asyncio.wait_for(stop_event.wait(), remaining)
+        except asyncio.TimeoutError:
+            return True
+        if stop_event.is_set():
+            print("Pattern output interrupted")
+            return False
+        return True
+
+    @on_device_thread
     def close(self):
         print("Entering close method")
         if self.dig:
@@ -138,7 +406,9 @@ class M2KDigital:
         else:
             print("M2KDigital connection already closed or not initialized.")
 
+    @on_device_thread
     def reset(self):
+        self.config.invalidate()
         if self.dig:
             self.dig.reset()
         else:
@@ -148,15 +418,19 @@ class M2KDigital:
         else:
             print("self.ctx is None in reset method")
 
-    async def stop_and_close(self):
+    async def stop_and_close(self, reset: bool = True):
+        await device_io.run(self._stop_and_close, reset)
+
+    def _stop_and_close(self, reset: bool = True):
+        # reset=Falseはリピートの途中の回で使う（チャネル設定を残し、次の回のsetup_channelsを差分だけにする）
         global enabled_channels
         if self.dig:
             try:
                 self.dig.stopBufferOut()
                 if enabled_channels:
-                    zero_buffer = [0] * 4
+                    zero_buffer = np.zeros(4, dtype=np.uint16)
                     try:
-                        self.dig.push(zero_buffer)
+                        self.push(zero_buffer)
                         print("Zero buffer pushed successfully")
                     except Exception as e:
                         print(f"Error pushing zero buffer: {e}")
@@ -164,69 +438,136 @@ class M2KDigital:
             except Exception as e:
                 print(f"Error in stop_and_close: {e}")
             finally:
-                try:
-                    self.dig.reset()
-                except Exception as e:
-                    print(f"Error resetting M2KDigital device: {e}")
+                if reset:
+                    self.config.invalidate()
+                    try:
+                        self.dig.reset()
+                    except Exception as e:
+                        print(f"Error resetting M2KDigital device: {e}")
         else:
             print("self.dig is None in stop_and_close")
 
+    @on_device_thread
     def enable_channel(self, channel: int, enable: bool):
         self.dig.enableChannel(channel, enable)
+        self.config.enabled[channel] = bool(enable)
 
+    @on_device_thread
     def set_direction(self, channel: int, direction: int):
         self.dig.setDirection(channel, direction)
+        self.config.directions[channel] = direction
 
+    @on_device_thread
     def set_value_raw(self, channel: int, value: int):
         self.dig.setValueRaw(channel, value)
+        self.config.raw[channel] = value
 
+    @on_device_thread
     def get_value_raw(self, channel: int) -> int:
         return self.dig.getValueRaw(channel)
 
+class M2KSession:
+    """
+    ADALM2000への接続を一度だけ開いて使い回す。使用前に毎回ヘルスチェックを行い、
+    応答がなければ間隔を倍にしながら（バックオフ）再接続する。
+    """
+    def __init__(self, uri: str, retries: int = 4, backoff: float = 0.5):
+        self.uri = uri
+        self.retries = retries
+        self.backoff = backoff
+        self.device = None
+        self.connects = 0  # 接続（再接続を含む）した回数
+
+    def is_healthy(self) -> bool:
+        if self.device is None:
+            return False
+        try:
+            self.device.dig.getSampleRateOut()  # デバイスとの通信が必要な軽い問い合わせ
+            return True
+        except Exception as e:
+            print(f"M2K health check failed: {e}")
+            return False
+
+    @on_device_thread
+    def get(self) -> 'M2KDigital':
+        """正常な接続を返す（必要なら再接続する）"""
+        if self.is_healthy():
+            return self.device
+        self.disconnect()
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.device = M2KDigital(self.uri)
+                self.connects += 1
+                print(f"M2K session opened: {self.uri} (connection #{self.connects})")
+                return self.device
+            except Exception as e:
+                print(f"M2K connection attempt {attempt}/{self.retries} failed: {e}")
+                if attempt == self.retries:
+                    raise ConnectionError(f"Could not connect to ADALM2000 at {self.uri}") from e
+                time.sleep(delay)
+                delay *= 2
+
+    @on_device_thread
+    def disconnect(self):
+        if self.device is not None:
+            try:
+                libm2k.contextClose(self.device.ctx)
+            except Exception as e:
+                print(f"Error closing M2K context: {e}")
+            self.device = None
+
+def acquire_device() -> 'M2KDigital':
+    return get_m2k_session().get()
+
+def get_m2k_session() -> M2KSession:
+    # IPアドレスが変わった場合は接続を開き直す
+    global m2k_session
+    if m2k_session is None or m2k_session.uri != global_m2k_ip:
+        if m2k_session:
+            m2k_session.disconnect()
+        m2k_session = M2KSession(global_m2k_ip)
+    return m2k_session
+
 def channel_control_dialog(page: ft.Page):
     global global_m2k, global_m2k_ip
     
     load_containers_info()
     
-    if global_m2k:  # Noneでない場合のみclose()を実行
-        global_m2k.close()
-    
-    global_m2k = M2KDigital(global_m2k_ip)
+    global_m2k = device_io.call(acquire_device)  # 開いている接続があれば使い回す
 
     channel_controls = {}
+    # 各チャネルのレベル（ビットマスク、1=HIGH）。開いたときに一度だけ読み、以降は書き込んだ値で更新する
+    channel_values = global_m2k.read_values()
+
+    def apply_values(mask: int, values: int):
+        # maskのチャネルをまとめて書き込み、画面の更新は最後に1回だけ行う
+        nonlocal channel_values
+        global_m2k.write_values(mask, values)
+        channel_values = (channel_values & ~mask) | (values & mask)
+        for channel in range(16):
+            if (mask >> channel) & 1:
+                update_channel_controls(channel)
+        update_master_switch()
+        page.update()
 
     def on_master_switch_change(e):
-        for channel in range(16):
-            global_m2k.enable_channel(channel, e.control.value)
-            global_m2k.set_direction(channel, libm2k.DIO_OUTPUT)
-            new_value = libm2k.HIGH if e.control.value else libm2k.LOW
-            global_m2k.set_value_raw(channel, new_value)
-            update_channel_controls(channel)
+        apply_values(0xFFFF, 0xFFFF if e.control.value else 0)
 
     def on_value_change(e):
         channel = e.control.data["channel"]
-        enabled = e.control.value
-        global_m2k.enable_channel(channel, enabled)
-        global_m2k.set_direction(channel, libm2k.DIO_OUTPUT)
-        new_value = libm2k.HIGH if enabled else libm2k.LOW
-        global_m2k.set_value_raw(channel, new_value)
-        update_channel_controls(channel)
-        update_master_switch()
+        apply_values(1 << channel, (1 << channel) if e.control.value else 0)
 
     def update_channel_controls(channel):
         value_switch = channel_controls[channel]
 
-        enabled = global_m2k.get_value_raw(channel) == libm2k.HIGH
+        enabled = bool((channel_values >> channel) & 1)
         value_switch.value = enabled
         value_switch.active_color = ft.Colors.RED if enabled else ft.Colors.RED_900
         value_switch.thumb_color = ft.Colors.WHITE
 
-        page.update()
-
     def update_master_switch():
-        all_on = all(global_m2k.get_value_raw(channel) == libm2k.HIGH for channel in range(16))
-        master_switch.value = all_on
-        page.update()
+        master_switch.value = channel_values == 0xFFFF
 
     master_switch = ft.CupertinoSwitch(
         value=False,
@@ -297,9 +638,7 @@ def channel_control_dialog(page: ft.Page):
 def close_dialog(page):
     global global_m2k
     if global_m2k:
-        for channel in range(16):
-            global_m2k.enable_channel(channel, False)
-            global_m2k.set_value_raw(channel, libm2k.LOW)
+        global_m2k.write_values(0xFFFF, 0, output_mask=0)  # 全チャネルを無効・LOWにする（方向は変更しない）
     if page.overlay and len(page.overlay) > 0:
         dialog = page.overlay.pop()
         dialog.open = False
@@ -407,6 +746,91 @@ def play_dialog(page: ft.Page, get_dataframes_func):
             field.error_text = "Please enter a valid integer"
         page.update()
 
+    def validate_planner_field(e):
+        try:
+            if float(e.control.value) < 0:
+                e.control.error_text = "Must be a non-negative number"
+            else:
+                e.control.error_text = None
+        except ValueError:
+            e.control.error_text = "Please enter a valid number"
+        page.update()
+
+    tolerance_field = ft.TextField(
+        label="Max timing error (ns)",
+        value=str(global_error_tolerance_ns),
+        keyboard_type=ft.KeyboardType.NUMBER,
+        on_change=validate_planner_field,
+        width=150
+    )
+
+    memory_cap_field = ft.TextField(
+        label="Memory cap (MB)",
+        value=str(global_memory_cap_mb),
+        keyboard_type=ft.KeyboardType.NUMBER,
+        on_change=validate_planner_field,
+        width=150
+    )
+
+    plan_table = ft.DataTable(
+        columns=[
+            ft.DataColumn(ft.Text("Rate (Hz)"), numeric=True),
+            ft.DataColumn(ft.Text("Samples"), numeric=True),
+            ft.DataColumn(ft.Text("Buffer"), numeric=True),
+            ft.DataColumn(ft.Text("Max error"), numeric=True),
+            ft.DataColumn(ft.Text("Transfer"), numeric=True),
+        ],
+        rows=[],
+        visible=False,
+        data_row_max_height=30,
+        data_row_min_height=30,
+    )
+
+    def select_planned_rate(sample_rate):
+        sample_rate_field.value = str(sample_rate)
+        for row in plan_table.rows:
+            row.selected = row.data == sample_rate
+        validate_sample_rate(sample_rate_field)
+
+    def on_plan_click(_):
+        global global_error_tolerance_ns, global_memory_cap_mb
+        if tolerance_field.error_text or memory_cap_field.error_text:
+            return
+        global_error_tolerance_ns = float(tolerance_field.value)
+        global_memory_cap_mb = float(memory_cap_field.value)
+        best, candidates = plan_sample_rate(get_current_dataframes(), global_error_tolerance_ns * 1e-9,
+                                            int(global_memory_cap_mb * 2**20), cyclic=global_cyclic_enabled)
+        plan_table.rows = [
+            ft.DataRow(cells=[
+                ft.DataCell(ft.Text(str(c.sample_rate))),
+                ft.DataCell(ft.Text(str(c.total_samples))),
+                ft.DataCell(ft.Text(format_bytes(c.buffer_bytes))),
+                ft.DataCell(ft.Text(format_seconds(c.max_error),
+                                    color=ft.Colors.GREEN if c.max_error <= global_error_tolerance_ns * 1e-9 else None,
+                                    # チャネルごとの最大誤差をツールチップで表示
+                                    tooltip="\n".join(f"{name}: {format_seconds(error)}" for name, error in c.channel_errors.items() if error > 0) or None)),
+                ft.DataCell(ft.Text(format_seconds(c.transfer_time))),
+            ],
+            on_select_changed=lambda e: select_planned_rate(e.control.data),
+            data=c.sample_rate)
+            for c in candidates
+        ]
+        plan_table.visible = True
+        if best:
+            select_planned_rate(best.sample_rate)
+        else:
+            page.snack_bar = ft.SnackBar(content=ft.Text("No sample rate meets the error tolerance within the memory cap"))
+            page.snack_bar.open = True
+            page.update()
+
+    plan_button = ft.ElevatedButton("Plan", on_click=on_plan_click)
+
+    planner_row = ft.Row([
+        tolerance_field,
+        memory_cap_field,
+        plan_button
+    ], alignment=ft.MainAxisAlignment.START)
+
     def validate_cycle_count(e):
         global global_cycle_count
         try:
@@ -441,6 +865,21 @@ def play_dialog(page: ft.Page, get_dataframes_func):
         update_repeat_and_interval_visibility()
         page.update()
 
+    def toggle_periodic_split(e):
+        global global_periodic_split_enabled
+        global_periodic_split_enabled = e.control.value
+        page.update()
+
+    def toggle_streaming(e):
+        global global_streaming_enabled
+        global_streaming_enabled = e.control.value
+        page.update()
+
+    def toggle_mapped_buffer(e):
+        global global_mapped_enabled
+        global_mapped_enabled = e.control.value
+        page.update()
+
     def toggle_repeat_options(e):
         global global_repeat_enabled
         global_repeat_enabled = repeat_checkbox.value
@@ -470,6 +909,24 @@ def play_dialog(page: ft.Page, get_dataframes_func):
         visible=global_cyclic_enabled
     )
 
+    mapped_checkbox = ft.Checkbox(
+        label="Disk-backed buffer (for very long patterns)",
+        value=global_mapped_enabled,
+        on_change=toggle_mapped_buffer
+    )
+
+    streaming_checkbox = ft.Checkbox(
+        label="Streaming output (non-cyclic, render while playing)",
+        value=global_streaming_enabled,
+        on_change=toggle_streaming
+    )
+
+    periodic_split_checkbox = ft.Checkbox(
+        label="Experimental: push repeating tail once (non-cyclic, gap before tail, approximate stop time)",
+        value=global_periodic_split_enabled,
+        on_change=toggle_periodic_split
+    )
+
     cyclic_row = ft.Row([
         cyclic_checkbox,
         cycle_count_field,
@@ -538,9 +995,31 @@ def play_dialog(page: ft.Page, get_dataframes_func):
         on_click=toggle_interval_picker,
     )
 
+    def validate_interval_ms(e):
+        global global_interval_ms
+        try:
+            value = int(e.control.value or 0)
+            if not 0 <= value <= 999:
+                e.control.error_text = "0-999"
+            else:
+                e.control.error_text = None
+                global_interval_ms = value
+        except ValueError:
+            e.control.error_text = "Integer"
+        page.update()
+
+    interval_ms_field = ft.TextField(
+        label="ms",
+        value=str(global_interval_ms),
+        keyboard_type=ft.KeyboardType.NUMBER,
+        on_change=validate_interval_ms,
+        width=80
+    )
+
     interval_row = ft.Row([
         interval_button,
-        interval_text
+        interval_text,
+        interval_ms_field
     ], alignment=ft.MainAxisAlignment.START, visible=global_repeat_enabled)
 
     # 現在の出力回数を表示するためのテキストフィールドを追加
@@ -555,6 +1034,28 @@ def play_dialog(page: ft.Page, get_dataframes_func):
         countdown_text
     ], alignment=ft.MainAxisAlignment.START)
 
+    # 描画キャッシュのヒット/ミスを表示するためのテキスト
+    cache_stats_text = ft.Text("", size=12, color=ft.Colors.GREY_700)
+
+    def show_countdown(remaining: int):
+        countdown_text.value = f"Next pattern in {remaining}s"
+        countdown_text.visible = True
+        page.update()
+
+    def update_cache_stats(scheduler: RepeatScheduler = None):
+        stats = render_cache.stats()
+        cache_stats_text.value = (f"Render cache: {stats['hits']} hits / {stats['misses']} misses, "
+                                  f"{stats['entries']} buffers ({format_bytes(stats['bytes'])})")
+        if global_streaming_enabled and global_stream_stats:
+            cache_stats_text.value += (f"\nStreaming: {global_stream_stats['chunks']} chunks, "
+                                       f"{global_stream_stats['underruns']} underruns ({format_seconds(global_stream_stats['underrun_time'])})")
+        if global_device_stats and global_device_stats['total'] is not None:
+            cache_stats_text.value += (f"\nDevice calls: {global_device_stats['total']} per play "
+                                       f"(channel setup {global_device_stats['setup']}, {global_device_stats['skipped']} settings unchanged)")
+        if scheduler and len(scheduler.records) > 1:
+            cache_stats_text.value += (f"\nStart jitter: last {scheduler.records[-1].jitter * 1000:+.3f} ms, "
+                                       f"max {scheduler.max_jitter() * 1000:.3f} ms")
+
     # IPアドレス表示フィールドを追加
     ip_address_display = ft.TextField(
         label="ADALM2000 IP Address",
@@ -564,6 +1065,7 @@ def play_dialog(page: ft.Page, get_dataframes_func):
 
     stop_flag = False
     is_running = False
+    current_stop_event = None  # 出力中の回のstop_event（Stopで即座にセットする）
 
     def update_play_button_state():
         play_stop_button.disabled = len(enabled_channels) == 0
@@ -575,13 +1077,13 @@ def play_dialog(page: ft.Page, get_dataframes_func):
 
     async def on_play_stop(_):
         global global_sample_rate, global_repeat_count, global_interval_seconds, global_repeat_enabled, global_m2k, current_task
-        nonlocal stop_flag, is_running
+        nonlocal stop_flag, is_running, current_stop_event
 
         if not is_running:
             if sample_rate_field.error_text:
                 return
 
-            if global_repeat_enabled and repeat_count_field.error_text:
+            if global_repeat_enabled and (repeat_count_field.error_text or interval_ms_field.error_text):
                 return
 
             if global_cyclic_enabled and cycle_count_field.error_text:
@@ -604,9 +1106,13 @@ def play_dialog(page: ft.Page, get_dataframes_func):
                 sample_rate = global_sample_rate
                 repeat_count = global_repeat_count if global_repeat_enabled else 1
                 cycle_count = global_cycle_count if global_cyclic_enabled else 1
-                interval_seconds = global_interval_seconds if global_repeat_enabled else 0
+                interval_seconds = global_interval_seconds + global_interval_ms / 1000 if global_repeat_enabled else 0
                 print(f"Play button clicked - Sample rate: {sample_rate}, Repeat count: {repeat_count}, Cycle count: {cycle_count}, Interval: {interval_seconds} seconds")
 
+                # 各回の開始時刻は最初の回からの絶対時刻で決める（待ち時間の誤差が累積しない）
+                scheduler = RepeatScheduler(interval_seconds)
+                job = None
+                unreset_device = None  # リセットせずに次の回へ引き継いだデバイス
                 for i in range(repeat_count):
                     if stop_flag:
                         print("Pattern output stopped by user")
@@ -617,41 +1123,46 @@ def play_dialog(page: ft.Page, get_dataframes_func):
                     countdown_text.value = ""  # カウントダウンテキストをクリア
                     page.update()
 
-                    start_time = time.time()
-                    print(f"Starting pattern {i+1}/{repeat_count}")
                     try:
-                        stop_event = asyncio.Event()
-                        # パターン出力の直前に最新のdataframesを取得する関数を渡す
-                        current_task = asyncio.create_task(output_to_m2k(get_dataframes_func, stop_event, sample_rate))
+                        if job is None:
+                            # 最新のdataframesを取得する関数を渡す（準備はprepare_output_jobの中で行う）
+                            job = await prepare_output_job(get_dataframes_func, sample_rate)
+                        if i == 0:
+                            scheduler.start()
+                        elif not await scheduler.wait_for(i, lambda: stop_flag, show_countdown):
+                            break
+                        elif job.pattern_versions != pattern_versions(get_dataframes_func()):
+                            # 待っている間にパターンが編集・再読み込みされた場合は、事前に準備したジョブを捨てて作り直す
+                            # （この回の開始は作り直しにかかる時間だけ遅れ、jitterとして記録される）
+                            print(f"Pattern changed during the interval; re-preparing pattern {i+1}/{repeat_count}")
+                            job = await prepare_output_job(get_dataframes_func, sample_rate)
+                        countdown_text.visible = False
+                        record = scheduler.record(i)
+                        print(f"Starting pattern {i+1}/{repeat_count} (jitter {record.jitter * 1000:+.3f} ms)")
+                        stop_event = current_stop_event = asyncio.Event()
+                        # 最後の回以外はリセットせず、次の回のチャネル設定を差分だけにする
+                        last_iteration = i == repeat_count - 1
+                        current_task = asyncio.create_task(run_output_job(job, stop_event, reset=last_iteration))
+                        unreset_device = None if last_iteration else job.device
+                        job = None
                         await current_task
                         print(f"Pattern {i+1}/{repeat_count} sent")
+                        update_cache_stats(scheduler)
+                        page.update()
+
+                        # 次の回のバッファ描画とチャネル設定を開始予定時刻より前に済ませておく
+                        # （待っている間の編集は、開始予定時刻にpattern_versionsを比べて反映する）
+                        if i < repeat_count - 1 and not stop_flag:
+                            job = await prepare_output_job(get_dataframes_func, sample_rate)
                     except Exception as error:
                         print(f"Error during pattern {i+1}: {str(error)}")
                         break
 
-                    # 次のパターン出力までの待ち時間（カウントダウン）
-                    if i < repeat_count - 1 and not stop_flag: # １回パターンを出力した後、Stopボタンがクリックされていない場合に実行される
-                        print("Entering interval period")
-                        if global_m2k:
-                            await global_m2k.stop_and_close() # バッファーの転送中断、ゼロバッファーのプッシュおよびsleepを含むが効果なし
-                        
-                        elapsed_time = time.time() - start_time
-                        remaining_interval = max(0, interval_seconds - elapsed_time)
-                        print(f"Waiting for next pattern. Interval: {remaining_interval:.1f}s")
-                        countdown_text.visible = True
-                        page.update()
-                        for remaining in range(int(remaining_interval), 0, -1):
-                            if stop_flag:
-                                break
-                            countdown_message = f"Next pattern in {remaining}s"
-                            print(countdown_message)
-                            countdown_text.value = countdown_message
-                            countdown_text.visible = True
-                            page.update()
-                            await asyncio.sleep(1)
+                if unreset_device:
+                    await unreset_device.stop_and_close()  # 途中で終わった場合もデバイスをリセットしておく
 
-                        countdown_text.visible = False
-                        page.update()
+                countdown_text.visible = False
+                page.update()
 
                 if not stop_flag:
                     print("All patterns sent.")
@@ -673,6 +1184,10 @@ def play_dialog(page: ft.Page, get_dataframes_func):
         else: # is_runningがTrueの場合 -> ユーザーの操作によるパターン出力の中断
             if not stop_flag:
                 stop_flag = True
+                if current_stop_event:
+                    current_stop_event.set()  # 出力終了を待っている処理をすぐに起こす
+                if global_m2k:
+                    global_m2k.cancel()  # 専用スレッドで実行中のpushを中断する
                 if current_task:
                     current_task.cancel()
                 if global_m2k:
@@ -685,6 +1200,7 @@ def play_dialog(page: ft.Page, get_dataframes_func):
 
     play_stop_button = ft.ElevatedButton("Play", on_click=on_play_stop)
     update_play_button_state()
+    update_cache_stats()
 
     # 初期状態の設定
     update_repeat_and_interval_visibility()
@@ -696,13 +1212,19 @@ def play_dialog(page: ft.Page, get_dataframes_func):
                 [
                     ip_address_display,  # IPドレス表示フィールドを追加
                     sample_rate_field,
+                    planner_row,
+                    plan_table,
                     separator,
                     cyclic_row,
+                    mapped_checkbox,
+                    streaming_checkbox,
+                    periodic_split_checkbox,
                     separator,
                     repeat_row,
                     interval_row,
                     interval_picker,
                     status_row,
+                    cache_stats_text,
                     separator,
                     play_stop_button
                 ],
@@ -724,11 +1246,41 @@ def play_dialog(page: ft.Page, get_dataframes_func):
     dialog.open = True
     page.update()
 
-async def output_to_m2k(get_dataframes_func, stop_event: Event, sample_rate: int = None):
-    global enabled_channels, global_buffer, global_sample_rate, global_m2k, global_cyclic_enabled, global_m2k_ip
+def prepare_output(dataframes, sample_rate: int, cyclic: bool, periodic=False, memory_cap: Optional[int] = None):
+    """出力用のバッファを描画し、(PeriodicSplit または None, RenderedPattern または None) を返す"""
+    if cyclic:
+        # パターン全体が短い周期の繰り返しなら、1周期分だけを描画・転送する（出力される波形は同じ）
+        periodic_split = split_cyclic_period(dataframes, sample_rate, memory_cap)
+    else:
+        # periodic=Trueの非cyclic出力で末尾が周期的に繰り返している場合は、先頭部分と1周期分だけを描画・転送する
+        # （実験的。転送量は減るが、切り替えの隙間と停止時刻の誤差があるため既定では無効）
+        periodic_split = split_periodic(dataframes, sample_rate) if periodic else None
+    if periodic_split:
+        return periodic_split, None
+    # dataframesから直接サンプルワード列を生成（cyclicの場合はサンプル数を４の倍数に調整済み。
+    # unrollでmemory_capを超える場合だけサンプルレートを下げる）
+    return None, render_pattern(dataframes, sample_rate, cyclic=cyclic, memory_cap=memory_cap)
+
+class OutputJob(NamedTuple):
+    periodic_split: Optional[PeriodicSplit]  # 先頭部分＋周期に分割して出力する場合
+    rendered: Optional[RenderedPattern]      # バッファ全体を出力する場合
+    stream: Optional[Iterator[np.ndarray]]   # チャンクごとに描画しながら出力する場合
+    chunk_samples: Optional[int]             # streamの1チャンクのサンプル数
+    device: 'M2KDigital'                     # チャネル設定済みのデバイス
+    start_time: float
+    device_calls: int                        # 準備を始めた時点のデバイス呼び出し回数
+    pattern_versions: tuple                  # 準備に使ったパターンの変更番号（pattern_versions）
+
+def pattern_versions(dataframes) -> tuple:
+    """パターンが編集・再読み込みされたかを判定するための、チャネル名と変更番号の組（ハッシュ計算なしで比較できる）"""
+    return tuple((name, channel.version) for name, channel in dataframes.items()) + (tuple(enabled_channels),)
+
+async def prepare_output_job(get_dataframes_func, sample_rate: int = None) -> OutputJob:
+    """バッファの描画とデバイスの接続・チャネル設定までを行い、pushするだけの状態にする"""
+    global enabled_channels, global_buffer, global_sample_rate, global_m2k, global_cyclic_enabled, global_m2k_ip, global_device_stats
     
     start_time = time.time()
-    print(f"{time.time():.3f}: Starting output_to_m2k")
+    print(f"{time.time():.3f}: Starting output job")
     
     # パターン出力の直前に最新のdataframesを取得（新しく開いたファイルのdataframesが反映される）
     dataframes = get_dataframes_func()
@@ -739,45 +1291,114 @@ async def output_to_m2k(get_dataframes_func, stop_event: Event, sample_rate: int
     print(f"{time.time():.3f}: Preparing buffer and sample rate")
     if sample_rate is None:
         sample_rate = calculate_optimal_sample_rate(dataframes)
-    # ToDo：global_cyclic_enabledがTrueの場合はサンプル数を４の倍数に調整する
-    global_sample_rate = sample_rate  # グローバル変数を更新
-    # dataframesをcsv形式のオブジェクトに変換
-    csv_content = export_to_string_io(dataframes, format_type='scopy', sample_rate=sample_rate, cyclic=global_cyclic_enabled)
+    memory_cap = int(global_memory_cap_mb * 2**20)  # cyclic調整でバッファが超えてはならない上限 [bytes]
+    stream = None
+    chunk_samples = None
+    if global_streaming_enabled and not global_cyclic_enabled:
+        # 全体を描画せず、出力しながらチャンクごとに描画する（最初のチャンクができた時点で出力を開始）
+        periodic_split = rendered = None
+        compiled = plane_cache.compile(dataframes, sample_rate)
+        total_samples = compiled.total_samples
+        # 1チャンクより短いパターンはチャンクの大きさまでゼロ埋めしない（total_samplesは4の倍数）
+        chunk_samples = min(global_stream_chunk_samples, total_samples)
+        stream = iter_word_chunks(compiled, chunk_samples)
+        global_buffer = None
+        global_sample_rate = compiled.sample_rate
+        stats = transition_stats(compiled, len(dataframes))
+        print(f"Streaming output: {chunk_samples} samples/chunk, {global_kernel_buffers} kernel buffers, "
+              f"{stats['transitions']} transitions (duty {', '.join(f'{d:.1%}' for d in stats['duty'])})")
+    elif global_mapped_enabled:
+        # csv_files配下のファイルにチャンクごとに描画し、メモリマップから出力する（ファイル自体が再利用される）
+        # 大きなパターンの描画でUIが止まらないよう、描画はイベントループとは別のスレッドで行う
+        mapped = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: render_to_memmap(dataframes, sample_rate, global_cyclic_enabled, memory_cap=memory_cap))
+        print(f"Memory-mapped buffer: {mapped.words.filename}")
+        periodic_split = rendered = None
+        if global_cyclic_enabled:
+            # cyclic出力はバッファ全体を1回でpushする必要があるため、メモリ上限を超えるものは出力しない
+            if mapped.words.nbytes > global_memory_cap_mb * 1024 * 1024:
+                raise ValueError(f"Cyclic buffer ({format_bytes(mapped.words.nbytes)}) exceeds the memory cap "
+                                 f"({global_memory_cap_mb} MB); use non-cyclic output for this pattern")
+            rendered = mapped
+        else:
+            # 非cyclic出力はメモリマップからチャンクごとにpushする（全体をPythonのリストに変換しない）
+            total_samples = mapped.total_samples
+            chunk_samples = min(global_stream_chunk_samples, total_samples)
+            stream = iter_buffer_chunks(mapped.words, chunk_samples)
+            global_buffer = None
+            global_sample_rate = mapped.sample_rate
+    else:
+        # パターン内容と出力条件が前回と同じなら、描画済みのバッファを再利用する
+        cache_key = (render_cache.make_key(dataframes, sample_rate, global_cyclic_enabled, enabled_channels)
+                     + (global_periodic_split_enabled, memory_cap))
+        periodic_split, rendered = render_cache.get_or_render(
+            cache_key, lambda: prepare_output(dataframes, sample_rate, global_cyclic_enabled, global_periodic_split_enabled, memory_cap))
+        print(f"Render cache: {render_cache.stats()}")
+    if periodic_split:
+        global_buffer = periodic_split.period
+        global_sample_rate = int(sample_rate)
+        total_samples = periodic_split.total_samples
+        pushed_bytes = periodic_split.prefix.nbytes + periodic_split.period.nbytes
+        print(f"Periodic split: prefix {len(periodic_split.prefix)} samples + period {periodic_split.period_samples} samples "
+              f"(push {format_bytes(pushed_bytes)} instead of {format_bytes(total_samples * 2)})")
+    elif rendered is not None:
+        global_buffer = rendered.words
+        global_sample_rate = rendered.sample_rate
+        total_samples = rendered.total_samples
+        if rendered.alignment:
+            print(f"Cyclic alignment: {rendered.alignment.strategy} (period {rendered.alignment.period_samples} samples x {rendered.alignment.repeats})")
+        if global_sample_rate != sample_rate: # cyclic調整でレートを変更した場合
+            print(f"Warning: Rendered sample rate ({global_sample_rate}) differs from specified rate ({sample_rate})")
     # パターン出力にかかる時間を計算
-    csv_content.seek(0)
-    csv_lines = csv_content.readlines()
-    data_lines = len(csv_lines) - 8
-    theoretical_duration = data_lines / sample_rate
+    theoretical_duration = total_samples / global_sample_rate
     print(f"Theoretical pattern duration: {theoretical_duration:.3f} seconds")
-    print(f"CSV data lines: {data_lines}, Sample rate: {sample_rate}")
+    print(f"Total samples: {total_samples}, Sample rate: {global_sample_rate}")
+    print(f"{time.time():.3f}: Buffer rendered in {time.time() - start_time:.6f} seconds")
     
     global_m2k = None # M2KDigitalオブジェクトの初期化（m2kはグローバル変数）
-    pattern_send_start = time.time()
     try:
         #m2k_create_start = time.time()
         #print(f"{time.time():.3f}: Creating M2KDigital object")
-        global_m2k = M2KDigital(global_m2k_ip) # M2KDigitalオブジェクトの生成
+        # 接続は共有セッションを使い回す（初回と切断時のみ接続する）ため、リピートごとの処理は再設定とpushだけになる
+        global_m2k = await device_io.run(acquire_device)
+        calls_before = global_m2k.dig.calls
         #m2k_create_time = time.time() - m2k_create_start
         #print(f"M2KDigital creation time: {m2k_create_time:.6f} seconds")
-        # csv形式のオブジェクトからバッファーとサンプルレートを計算
-        #csv_to_buffer_start = time.time()
-        #print(f"{time.time():.3f}: Converting CSV to buffer")
-        global_buffer, global_sample_rate = global_m2k._csv_to_buffer(csv_content)
-        #csv_to_buffer_time = time.time() - csv_to_buffer_start
-        #print(f"CSV to buffer conversion time: {csv_to_buffer_time:.6f} seconds")
-
-        if global_sample_rate != sample_rate: # global_cyclic_enabledがTrueの場合にはあり得る
-            print(f"Warning: CSV sample rate ({global_sample_rate}) differs from specified rate ({sample_rate})")
         # パターンを出力するチャネルの設定
         #setup_start = time.time()
         #print(f"{time.time():.3f}: Setting up channels")
-        global_m2k.setup_channels(global_sample_rate)
+        skipped = await device_io.run(global_m2k.setup_channels, global_sample_rate)
+        global_device_stats = {'setup': global_m2k.dig.calls - calls_before, 'skipped': skipped, 'total': None}
+        print(f"Channel setup: {global_device_stats['setup']} device calls ({skipped} settings unchanged)")
         #setup_time = time.time() - setup_start
         #print(f"Channel setup time: {setup_time:.6f} seconds")
+    except Exception as e: # エラー処理
+        print(f"Error occurred while preparing pattern output: {str(e)}")
+        if global_m2k:
+            await device_io.run(global_m2k.reset) # エラーが発生したらADALM2000をリセット
+        raise
+    return OutputJob(periodic_split, rendered, stream, chunk_samples, global_m2k, start_time, calls_before, pattern_versions(dataframes))
+
+async def run_output_job(job: OutputJob, stop_event: Event, reset: bool = True):
+    """
+    準備済みのジョブをpushし、出力が終わるまで待つ。
+    reset=Falseの場合は出力後にデバイスをリセットせず、チャネル設定を次の回に引き継ぐ。
+    """
+    global global_buffer, global_stream_stats
+
+    pattern_send_start = time.time()
+    peak_rss_before = peak_rss_bytes()  # この再生で最大常駐メモリが増えたかを確認するため
+    device = job.device
+    try:
         # ADALM2000への転送
         print(f"{time.time():.3f}: Sending pattern")
         #send_start_time = time.time()
-        await global_m2k.send_pattern(global_buffer, stop_event)
+        if job.stream is not None:
+            global_stream_stats = await device.send_stream(job.stream, job.chunk_samples, stop_event, global_kernel_buffers)
+        elif job.periodic_split:
+            await device.send_periodic_pattern(job.periodic_split, stop_event)
+        else:
+            await device.send_pattern(job.rendered.words, stop_event, job.rendered.alignment.period_samples if job.rendered.alignment else None)
         #send_end_time = time.time()
         #actual_duration = send_end_time - send_start_time
         #print(f"{time.time():.3f}: Pattern sent to M2K device successfully. Sample rate: {global_sample_rate}")
@@ -787,22 +1408,28 @@ async def output_to_m2k(get_dataframes_func, stop_event: Event, sample_rate: int
         print("Pattern output cancelled")
     except Exception as e: # エラー処理
         print(f"Error occurred during pattern output: {str(e)}")
-        if global_m2k:
-            global_m2k.reset() # エラーが発生したらADALM2000をリセット
+        await device_io.run(device.reset) # エラーが発生したらADALM2000をリセット
         raise
     finally: # パターン出力後の処理
-        if global_m2k:
-            #close_start = time.time()
-            #print(f"{time.time():.3f}: Closing M2KDigital object")
-            await global_m2k.stop_and_close() # 最後に残ったデータの吐き出しを含む（awaitで実行するとなぜかエラーが発生 <- でも動作に悪影響はない）
-            #close_time = time.time() - close_start
-            #print(f"M2KDigital close time: {close_time:.6f} seconds")
+        #close_start = time.time()
+        #print(f"{time.time():.3f}: Closing M2KDigital object")
+        await device.stop_and_close(reset) # 最後に残ったデータの吐き出しを含む（awaitで実行するとなぜかエラーが発生 <- でも動作に悪影響はない）
+        #close_time = time.time() - close_start
+        #print(f"M2KDigital close time: {close_time:.6f} seconds")
+        global_buffer = None # 出力が終わったバッファは保持しない（描画結果はrender_cacheが管理する）
+        if global_device_stats is not None:
+            global_device_stats['total'] = device.dig.calls - job.device_calls
+            print(f"Device calls this play: {global_device_stats['total']}")
+        peak_rss = peak_rss_bytes()
+        if peak_rss is not None:
+            print(f"Peak RSS since process start: {format_bytes(peak_rss)} "
+                  f"(+{format_bytes(peak_rss - peak_rss_before)} during this play)")
 
     pattern_send_time = time.time() - pattern_send_start
     print(f"Total pattern send time: {pattern_send_time:.6f} seconds")
 
-    total_time = time.time() - start_time
-    print(f"{time.time():.3f}: output_to_m2k completed")
-    print(f"Total output_to_m2k time: {total_time:.6f} seconds")
+    total_time = time.time() - job.start_time
+    print(f"{time.time():.3f}: Output job completed")
+    print(f"Total output job time: {total_time:.6f} seconds")
 
 load_containers_info()  # コンテナ情報を読み込む
\ No newline at end of file
@@ -0,0 +1,210 @@
+# m2k_simulator.py
+# libm2kと同じ呼び出し方ができる、プロセス内のADALM2000（デジタル部）シミュレータ。
+# pushの転送時間（帯域）、出力タイミング、cyclicモード、チャネルの入出力方向、getValueRawを模擬し、
+# 直近のpushを記録する（ワード列はrecord_wordsを有効にした場合のみ保持する）。
+# 実機なしで再生パイプラインの検証・計測を行うために使う。
+
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+import numpy as np
+
+DIO_INPUT = 0
+DIO_OUTPUT = 1
+LOW = 0
+HIGH = 1
+
+NUM_CHANNELS = 16
+DEFAULT_SAMPLE_RATE = 100000000
+PUSH_BANDWIDTH = 20 * 1024 * 1024  # 模擬するpushの転送帯域 [bytes/s]
+OPEN_LATENCY = 0.05  # m2kOpenにかかる時間 [s]
+MAX_PUSH_RECORDS = 1024  # 保持するpushの記録数（古いものから捨てる。長時間の計測でメモリが増え続けないように）
+
+last_context = None  # 最後に開いたコンテキスト（記録の参照用）
+
+class PushRecord(NamedTuple):
+    time: float           # pushを受け付けた時刻（monotonic）
+    samples: int          # pushされたサンプル数
+    words: Optional[np.ndarray]  # pushされたワード列（uint16。record_wordsが無効の場合はNone）
+    cyclic: bool
+    sample_rate: int
+    transfer_time: float  # 模擬した転送時間 [s]
+    output_start: float   # 出力を開始した時刻（monotonic）
+
+class _Segment(NamedTuple):
+    start: float
+    end: float  # cyclicの場合は無限大
+    words: np.ndarray
+    sample_rate: int
+
+class SimDigital:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.pushed = deque(maxlen=MAX_PUSH_RECORDS)  # PushRecordの並び（直近MAX_PUSH_RECORDS回分）
+        self.record_words = False  # Trueにするとpushされたワード列も記録する（波形の検証用）
+        self.calls = 0  # デバイスAPIの呼び出し回数
+        self._reset_state()
+
+    def _reset_state(self):
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.cyclic = False
+        self.kernel_buffers = 4
+        self.directions = [DIO_INPUT] * NUM_CHANNELS
+        self.enabled = [False] * NUM_CHANNELS
+        self.raw = [LOW] * NUM_CHANNELS
+        self._segments = deque()
+        self._cancelled = False
+
+    def _count(self):
+        self.calls += 1
+
+    def _wait(self, timeout_at: float, until=lambda: False):
+        # timeout_atまで（またはuntil()が真になるまで）待つ。cancelBufferOutで中断されたら例外にする
+        with self._cond:
+            while not until():
+                if self._cancelled:
+                    self._cancelled = False
+                    raise RuntimeError("Buffer push cancelled")
+                remaining = timeout_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
+
+    def setSampleRateOut(self, rate):
+        self._count()
+        self.sample_rate = int(rate)
+
+    def getSampleRateOut(self):
+        self._count()
+        return self.sample_rate
+
+    def setCyclic(self, cyclic):
+        self._count()
+        self.cyclic = bool(cyclic)
+
+    def getCyclic(self):
+        self._count()
+        return self.cyclic
+
+    def setKernelBuffersCountOut(self, count):
+        self._count()
+        self.kernel_buffers = max(1, int(count))
+
+    def setDirection(self, channel, direction=None):
+        self._count()
+        if direction is None:
+            # setDirection(mask): 全チャネルの方向をビットマスク（1=出力）で設定する
+            self.directions = [DIO_OUTPUT if (channel >> ch) & 1 else DIO_INPUT for ch in range(NUM_CHANNELS)]
+        else:
+            self.directions[channel] = direction
+
+    def getDirection(self, channel):
+        self._count()
+        return self.directions[channel]
+
+    def enableChannel(self, channel, enable):
+        self._count()
+        self.enabled[channel] = bool(enable)
+
+    def setValueRaw(self, channel, value):
+        self._count()
+        if self.directions[channel] == DIO_OUTPUT:
+            self.raw[channel] = HIGH if value else LOW
+
+    def getValueRaw(self, channel):
+        self._count()
+        if self.directions[channel] != DIO_OUTPUT:
+            return LOW  # 入力チャネルには何も接続されていないものとする
+        word = self._current_word(time.monotonic())
+        if word is not None and self.enabled[channel]:
+            return (int(word) >> channel) & 1
+        return self.raw[channel]
+
+    def _current_word(self, now: float):
+        with self._cond:
+            for segment in self._segments:
+                if segment.start <= now < segment.end:
+                    index = int((now - segment.start) * segment.sample_rate)
+                    return segment.words[index % len(segment.words)]
+        return None
+
+    def push(self, data):
+        self._count()
+        words = np.array(data, dtype=np.uint16)
+        received = time.monotonic()
+        transfer_time = words.nbytes / PUSH_BANDWIDTH
+        self._wait(received + transfer_time)
+
+        if not self.cyclic:
+            # カーネルバッファがすべて出力待ちの間はブロックする（実機のpushと同じ振る舞い）
+            def has_free_buffer():
+                now = time.monotonic()
+                while self._segments and self._segments[0].end <= now:
+                    self._segments.popleft()
+                return len(self._segments) < self.kernel_buffers
+            oldest_end = lambda: self._segments[0].end if self._segments else 0.0
+            while True:
+                with self._cond:
+                    if has_free_buffer():
+                        break
+                    timeout_at = oldest_end()
+                self._wait(timeout_at, has_free_buffer)
+
+        with self._cond:
+            now = time.monotonic()
+            if self.cyclic:
+                self._segments.clear()
+                start, end = now, float('inf')
+            else:
+                start = max(now, self._segments[-1].end if self._segments else now)
+                end = start + len(words) / self.sample_rate
+            self._segments.append(_Segment(start, end, words, self.sample_rate))
+            self.pushed.append(PushRecord(received, len(words), words if self.record_words else None,
+                                          self.cyclic, self.sample_rate, transfer_time, start))
+
+    def stopBufferOut(self):
+        self._count()
+        with self._cond:
+            word = self._current_word(time.monotonic())
+            if word is not None:
+                # 停止時点の出力レベルを保持する
+                self.raw = [(int(word) >> ch) & 1 for ch in range(NUM_CHANNELS)]
+            self._segments.clear()
+            self._cond.notify_all()
+
+    def cancelBufferOut(self):
+        self._count()
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def reset(self):
+        self._count()
+        with self._cond:
+            self._reset_state()
+            self._cond.notify_all()
+
+class SimContext:
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.digital = SimDigital()
+
+    def getDigital(self):
+        return self.digital
+
+    def getSerialNumber(self):
+        return "SIMULATED"
+
+    def reset(self):
+        self.digital.reset()
+
+def m2kOpen(uri: str = "ip:192.168.2.1"):
+    global last_context
+    time.sleep(OPEN_LATENCY)
+    last_context = SimContext(uri)
+    print(f"Simulated ADALM2000 opened at {uri}")
+    return last_context
+
+def contextClose(ctx, deinit=True):
+    pass
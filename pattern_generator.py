@@ -1,5 +1,4 @@
 import flet as ft
-import pandas as pd
 import argparse
 import chart_func as cgf
 import export_csv as ec
@@ -7,10 +6,12 @@ from file_operations import save_dataframes, save_dialog, load_dialog, delete_pk
 import view_operations as vo
 import edit_operations as eo
 from export_csv import export_csv_dialog, delete_csv_dialog
-from m2k_digital import enable_channels_dialog, play_dialog, channel_control_dialog
+from m2k_digital import enable_channels_dialog, play_dialog, channel_control_dialog, set_backend
+from m2k_backend import BACKENDS
+from pattern_model import ChannelPattern
 
 page = None
-dataframes = {}  # チャネルごとのDataFrameを辞書で管理
+dataframes = {}  # チャネルごとのChannelPatternを辞書で管理
 selected_rows = [] # 選択された行のデータを保持するためのリスト
 copied_rows = []    # コピーされた行のデータを保持するためのリスト
 channel_to_display = [] # 表示するチャネルを保持するためのリスト
@@ -57,28 +58,18 @@ channel_colors = [
     "#B0E0E6"   # ウダーブルー
 ]
 
-def create_channel_dataframe(): # 初期値を持たない空のデータフレームを作成（データ型を明示してpandasの更新に対応）
-    columns = {
-        "state": pd.Series(dtype=str),
-        "duration": pd.Series(dtype=float),
-        "unit": pd.Series(dtype=str)
-    }
-    return pd.DataFrame(columns=columns)
+def create_channel_pattern(): # 初期値を持たない空のChannelPatternを作成
+    return ChannelPattern()
 
-def create_initial_dataframes(): # 16チャネル分の空のDataFrameを辞書で管理
+def create_initial_dataframes(): # 16チャネル分の空のChannelPatternを辞書で管理
     dataframes = {}
     for i in range(16):
-        dataframes[f"Channel {i}"] = create_channel_dataframe()
+        dataframes[f"Channel {i}"] = create_channel_pattern()
     return dataframes
 
-def rows_to_dataframe(rows):
-    # DataRowからDataFrameを作成するためのデータを抽出
-    data = {
-        "state": [row.cells[1].content.value for row in rows],
-        "duration": [float(row.cells[2].content.value) for row in rows],
-        "unit": [row.cells[3].content.value for row in rows]
-    }
-    return pd.DataFrame(data)
+def rows_to_pattern(channel_pattern, rows):
+    # DataRowのdata属性（行インデックス）を使ってChannelPatternから行を取り出す
+    return channel_pattern.take([row.data for row in rows])
 
 def edit_dataframe(e, page, dataframes, action):
     global channel_dropdown, state_dropdown, duration_textfield, unit_dropdown, data_table, selected_rows, selected_index, copied_rows, repeat_count_textfield
@@ -92,39 +83,35 @@ def edit_dataframe(e, page, dataframes, action):
             # 選択された行のデータを更新
             for row in selected_rows:
                 index = row.data  # 選択された行のインデックス
-                dataframes[channel].loc[index, 'state'] = state
-                dataframes[channel].loc[index, 'duration'] = float(duration)
-                dataframes[channel].loc[index, 'unit'] = unit
+                try:
+                    dataframes[channel].set_row(index, state, duration, unit)
+                except ValueError as error:
+                    duration_textfield.error_text = str(error)
+                    page.update()
+                    return
     
     elif action == "delete" and delete_button.color == ft.Colors.BLUE_200:
         if selected_rows:
             indices_to_delete = [row.data for row in selected_rows] # 選択されたすべての行のインデックスを取得
-            dataframes[channel] = dataframes[channel].drop(indices_to_delete).reset_index(drop=True) # 選択され行を削除
+            dataframes[channel].delete(indices_to_delete) # 選択され行を削除
             range_slider.start_value = 0 # レンジをリセット
             range_slider.end_value = len(dataframes[channel]) # レンジをリセット
 
     elif action == "invert" and invert_button.color == ft.Colors.BLUE_200:
         if selected_rows:
-            for row in selected_rows:
-                index = row.data  # 選択された行のインデックス
-                current_state = dataframes[channel].loc[index, 'state']
-                # 状態を反転
-                new_state = 'low' if current_state == 'high' else 'high'
-                dataframes[channel].loc[index, 'state'] = new_state
+            # 選択された行の状態を反転
+            dataframes[channel].invert([row.data for row in selected_rows])
             
     if copied_rows: # コピーされた行がある場合
         repeat_count = int(repeat_count_textfield.value)
-        new_copied_rows = []
-        for _ in range(repeat_count):
-            new_copied_rows.extend(list(copied_rows))
-        # copied_rowsからDataFrameを作成
-        copied_data = rows_to_dataframe(new_copied_rows)
+        # copied_rowsからChannelPatternを作成し、繰り返し回数分並べる
+        copied_data = rows_to_pattern(dataframes[channel], copied_rows).repeat(repeat_count)
 
         if action == "above" and insert_above_button.color == ft.Colors.BLUE_200:
-            dataframes[channel] = pd.concat([dataframes[channel].iloc[:selected_index], copied_data, dataframes[channel].iloc[selected_index:]], ignore_index=True)
+            dataframes[channel].insert(selected_index, copied_data)
 
         elif action == "below" and insert_below_button.color == ft.Colors.BLUE_200:
-            dataframes[channel] = pd.concat([dataframes[channel].iloc[:selected_index + 1], copied_data, dataframes[channel].iloc[selected_index + 1:]], ignore_index=True)
+            dataframes[channel].insert(selected_index + 1, copied_data)
             
         copied_rows = []
         copy_button.text = "Copy"
@@ -167,19 +154,24 @@ def edit_dataframe(e, page, dataframes, action):
             page.update()
             return
         # 新しい行を作成
-        new_row = pd.DataFrame({"state": [state], "duration": [float(duration)], "unit": [unit]})
-        # 対象の DataFrame が空の場合は新しい DataFrame を直接代入（pandasの仕様変更に応）
-        if dataframes[channel].empty: # 空のdataframeに対しconcatで行を追加する場合
+        try:
+            new_row = ChannelPattern.from_rows([(state, duration, unit)])
+        except ValueError as error:
+            duration_textfield.error_text = str(error)
+            page.update()
+            return
+        # 対象のChannelPatternが空の場合は新しい行を直接代入
+        if dataframes[channel].empty:
             dataframes[channel] = new_row
-        else: # nullが含まれる行をconcat追加することまたはnullを含dataframeに対し新たな行をconcatで追加することは将来的に非推奨になる。
+        else:
             if action == "append" and append_button.color == ft.Colors.BLUE_200:
-                dataframes[channel] = pd.concat([dataframes[channel], new_row], ignore_index=True)
+                dataframes[channel].append(new_row)
             elif action == "below" and insert_below_button.color == ft.Colors.BLUE_200:
                 selected_index = selected_rows[0].data if selected_rows else len(dataframes[channel])
-                dataframes[channel] = pd.concat([dataframes[channel].iloc[:selected_index + 1], new_row, dataframes[channel].iloc[selected_index + 1:]], ignore_index=True)
+                dataframes[channel].insert(selected_index + 1, new_row)
             elif action == "above" and insert_above_button.color == ft.Colors.BLUE_200:
                 selected_index = selected_rows[0].data if selected_rows else 0
-                dataframes[channel] = pd.concat([dataframes[channel].iloc[:selected_index], new_row, dataframes[channel].iloc[selected_index:]], ignore_index=True)
+                dataframes[channel].insert(selected_index, new_row)
         range_slider.start_value = 0 # レンジをリセット
         range_slider.end_value = len(dataframes[channel]) # レンジをリセット
     channel_dropdown_change(channel, page) # UIを更新
@@ -215,6 +207,7 @@ def channel_dropdown_change(channel, page):
     # state, duration, unitのウィジェットの値をリセット
     state_dropdown.value = None
     duration_textfield.value = ""
+    duration_textfield.error_text = ""
     unit_dropdown.value = None
     button_row.visible = False
 
@@ -236,13 +229,13 @@ def channel_dropdown_change(channel, page):
     data_table.rows = [
         ft.DataRow(cells=[
             ft.DataCell(ft.Text(str(index))),
-            ft.DataCell(ft.Text(row["state"])),
-            ft.DataCell(ft.Text(str(row["duration"]))),
-            ft.DataCell(ft.Text(row["unit"]))
+            ft.DataCell(ft.Text(state)),
+            ft.DataCell(ft.Text(str(duration))),
+            ft.DataCell(ft.Text(unit))
         ], 
         on_select_changed=lambda e: row_select_changed(e, df, data_table, page),
         data=index)  # インデックスをdata属性に保存
-        for index, row in df.iterrows()
+        for index, (state, duration, unit) in enumerate(df.rows())
     ]
     page.update()
 
@@ -250,15 +243,15 @@ def channel_dropdown_change(channel, page):
         channel_to_display.append(channel)
 
     range_slider.min = 0
-    range_slider.max = len(df['duration'])
-    range_slider.divisions = len(df['duration'])
+    range_slider.max = len(df)
+    range_slider.divisions = len(df)
     range_slider.start_value = 0
-    range_slider.end_value = len(df['duration'])
+    range_slider.end_value = len(df)
     range_slider.update()
-    if range_slider.start_value > len(df['duration']):
+    if range_slider.start_value > len(df):
         range_slider.start_value = 0
-    if range_slider.end_value > len(df['duration']):
-        range_slider.end_value = len(df['duration'])
+    if range_slider.end_value > len(df):
+        range_slider.end_value = len(df)
     range_slider.update()
     selected_rows = []
     chart_update(channel_changed=True)
@@ -305,7 +298,7 @@ def row_select_changed(e, df, data_table, page):
     # ボタンの表示を更新
     button_row.visible = len(selected_rows) > 0
     # 選択された行のインデックスを取
-    selected_indices = [df.index.get_loc(row.data) for row in selected_rows]
+    selected_indices = [row.data for row in selected_rows]
     if not copied_rows: # コピーされた行がない場合
         # Correctボタンのテキスト色変更
         if len(selected_rows) == 1: # 選択された行が1つの場合
@@ -538,6 +531,13 @@ def parse_arguments():
     web_group.add_argument('--route-strategy', type=str, choices=['hash', 'path'], 
                           default='hash',
                           help='URLルーティング方式 (デフォルト: hash)')
+
+    # デバイス関連の引数グループ
+    device_group = parser.add_argument_group('Device options')
+    device_group.add_argument('--m2k-backend', type=str, choices=BACKENDS, default='libm2k',
+                              help='ADALM2000のバックエンド。sim は実機なしで動くシミュレータ (デフォルト: libm2k)')
+    device_group.add_argument('--sim-bandwidth', type=float, default=20.0,
+                              help='シミュレータで模擬するpushの転送帯域 [MB/s] (デフォルト: 20)')
     return parser.parse_args()
 
 ######### Main関数 #########
@@ -687,7 +687,8 @@ def main(page_arg: ft.Page):
         options=[
             ft.dropdown.Option(text="sec."),
             ft.dropdown.Option(text="msec."),
-            ft.dropdown.Option(text="microsec.")
+            ft.dropdown.Option(text="microsec."),
+            ft.dropdown.Option(text="nanosec.")
         ],
         hint_text="Select unit",
         on_change=lambda e: inputs_row_change(e, page)
@@ -820,7 +821,7 @@ def main(page_arg: ft.Page):
     # 初期チャートの表示
     if range_slider is not None:
         chart_update()
-    # チャネルごとのDataFrameを作成
+    # チャネルごとのChannelPatternを作成
     dataframes = create_initial_dataframes()
 
     # ページを更新
@@ -832,6 +833,10 @@ def get_current_dataframes():
 
 if __name__ == "__main__":
     args = parse_arguments()
+    if args.m2k_backend == 'sim':
+        import m2k_simulator
+        m2k_simulator.PUSH_BANDWIDTH = args.sim_bandwidth * 1024 * 1024
+    set_backend(args.m2k_backend)
     
     # AppViewの対応関係を定義
     view_mapping = {
@@ -845,6 +850,7 @@ if __name__ == "__main__":
         ft.app(
             target=main,
             view=ft.AppView.WEB_BROWSER,
+            assets_dir="assets",  # download_csvが書き出したファイルをWebサーバーから配信する
             route_url_strategy=args.route_strategy,
             port=args.port,
             host=args.host
@@ -852,5 +858,6 @@ if __name__ == "__main__":
     else:  # flet_app, flet_app_web, flet_app_hidden
         ft.app(
             target=main,
-            view=view_mapping[args.view]
+            view=view_mapping[args.view],
+            assets_dir="assets"
         )
@@ -0,0 +1,139 @@
+# pattern_model.py
+# チャネルごとのパターンを型付き配列で保持するモデル。
+# state は uint8、duration は整数tick（ナノ秒）、unit は表示用の単位インデックスで保持し、
+# pandas.DataFrame はUIとの境界（旧形式pklの読み込みなど）でのみ使用する。
+
+import itertools
+import numpy as np
+import pandas as pd
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Iterable, Iterator, Tuple
+
+STATE_NAMES = ('low', 'high')  # state配列の値 -> 表示名
+UNIT_NAMES = ('sec.', 'msec.', 'microsec.', 'nanosec.')  # unit配列の値 -> 表示名
+TICKS_PER_SECOND = 10**9  # durationの単位（1 tick = 1 ns）
+UNIT_TICKS = np.array([10**9, 10**6, 10**3, 1], dtype=np.int64)  # 単位ごとのtick数
+_versions = itertools.count(1)  # 全ChannelPatternで一意な変更番号（キャッシュのキーに使用）
+
+def state_code(state: str) -> int:
+    return STATE_NAMES.index(state)
+
+def unit_code(unit: str) -> int:
+    if unit not in UNIT_NAMES:
+        raise ValueError(f"Unknown unit: {unit}")
+    return UNIT_NAMES.index(unit)
+
+def to_ticks(duration, unit: str, exact=True) -> int:
+    # 入力文字列（またはfloatの最短表現）を10進数のまま扱い、浮動小数点の丸め誤差を持ち込まない
+    try:
+        ticks = Decimal(str(duration)) * int(UNIT_TICKS[unit_code(unit)])
+    except InvalidOperation:
+        raise ValueError(f"Invalid duration: {duration}")
+    if not ticks.is_finite():
+        raise ValueError(f"Invalid duration: {duration}")  # inf / nan はtick数に変換できない
+    if ticks != ticks.to_integral_value():
+        if exact:
+            raise ValueError(f"Duration must be a multiple of 1 ns: {duration} {unit}")
+        ticks = ticks.to_integral_value()  # 旧形式のデータは最も近いtickに丸める
+    return int(ticks)
+
+def ticks_to_samples(ticks, sample_rate: int) -> np.ndarray:
+    # floor(ticks * sample_rate / TICKS_PER_SECOND) を int64 の範囲内で正確に計算する
+    ticks = np.asarray(ticks, dtype=np.int64)
+    seconds, remainder = np.divmod(ticks, TICKS_PER_SECOND)
+    return seconds * sample_rate + remainder * sample_rate // TICKS_PER_SECOND
+
+class ChannelPattern:
+    __slots__ = ('states', 'durations', 'units', 'version', '_tick_gcd')
+
+    def __init__(self, states=(), durations=(), units=()):
+        self.states = np.asarray(states, dtype=np.uint8)
+        self.durations = np.asarray(durations, dtype=np.int64)
+        self.units = np.asarray(units, dtype=np.uint8)
+        self._touch()
+
+    def _touch(self):
+        # 配列を変更したら必ず呼び出し、チャネル単位のキャッシュを無効化する
+        self.version = next(_versions)
+        self._tick_gcd = None
+
+    def tick_gcd(self) -> int:
+        """このチャネルの全durationの最大公約数（変更されるまでキャッシュ）"""
+        if self._tick_gcd is None:
+            self._tick_gcd = int(np.gcd.reduce(self.durations)) if len(self.durations) else 0
+        return self._tick_gcd
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[str, object, str]], exact=True):
+        """(state, duration, unit) の表示値の並びから生成する（durationは文字列でも可）"""
+        rows = list(rows)
+        return cls([state_code(state) for state, _, _ in rows],
+                   [to_ticks(duration, unit, exact) for _, duration, unit in rows],
+                   [unit_code(unit) for _, _, unit in rows])
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame):
+        """旧形式（state, duration, unitの列を持つDataFrame）から変換する"""
+        return cls.from_rows(zip(df['state'], df['duration'], df['unit']), exact=False)
+
+    def __len__(self):
+        return len(self.states)
+
+    @property
+    def empty(self):
+        return len(self.states) == 0
+
+    def display_durations(self) -> np.ndarray:
+        """各行のdurationを行ごとの単位での値に戻す"""
+        return self.durations / UNIT_TICKS[self.units]
+
+    def rows(self) -> Iterator[Tuple[str, float, str]]:
+        for state, duration, unit in zip(self.states.tolist(), self.display_durations().tolist(), self.units.tolist()):
+            yield STATE_NAMES[state], duration, UNIT_NAMES[unit]
+
+    def take(self, indices) -> 'ChannelPattern':
+        indices = np.asarray(indices, dtype=np.intp)
+        return ChannelPattern(self.states[indices], self.durations[indices], self.units[indices])
+
+    def repeat(self, count: int) -> 'ChannelPattern':
+        return ChannelPattern(np.tile(self.states, count), np.tile(self.durations, count), np.tile(self.units, count))
+
+    def insert(self, index: int, other: 'ChannelPattern'):
+        self.states = np.concatenate((self.states[:index], other.states, self.states[index:]))
+        self.durations = np.concatenate((self.durations[:index], other.durations, self.durations[index:]))
+        self.units = np.concatenate((self.units[:index], other.units, self.units[index:]))
+        self._touch()
+
+    def append(self, other: 'ChannelPattern'):
+        self.insert(len(self), other)
+
+    def delete(self, indices):
+        self.states = np.delete(self.states, indices)
+        self.durations = np.delete(self.durations, indices)
+        self.units = np.delete(self.units, indices)
+        self._touch()
+
+    def set_row(self, index: int, state: str, duration, unit: str):
+        ticks = to_ticks(duration, unit)
+        self.states[index] = state_code(state)
+        self.durations[index] = ticks
+        self.units[index] = unit_code(unit)
+        self._touch()
+
+    def invert(self, indices):
+        self.states[indices] ^= 1
+        self._touch()
+
+    def __getstate__(self):
+        return {'states': self.states, 'durations': self.durations, 'units': self.units}
+
+    def __setstate__(self, state):
+        self.states = state['states']
+        self.durations = state['durations']
+        self.units = state['units']
+        self._touch()
+
+def ensure_channel_patterns(dataframes: Dict) -> Dict[str, ChannelPattern]:
+    """旧形式のpklに含まれるDataFrameをChannelPatternに変換する"""
+    return {channel: ChannelPattern.from_dataframe(df) if isinstance(df, pd.DataFrame) else df
+            for channel, df in dataframes.items()}
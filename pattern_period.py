@@ -0,0 +1,128 @@
+# pattern_period.py
+# 16チャネルを合成したランレングス列から「一度だけ出力する先頭部分＋繰り返し周期」を検出し、
+# 周期部分だけをcyclic出力すれば済むようにパターンを分割する。
+# cyclic出力でパターン全体が短い周期のk回の繰り返しになっている場合は、1周期分だけを転送する（出力は完全に同じ）。
+
+import math
+import numpy as np
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from pattern_model import ChannelPattern
+from pattern_render import plane_cache, expand_words, divisors, plan_cyclic_alignment
+
+MAX_PERIOD_CANDIDATES = 64  # 検証する周期候補の最大数
+MAX_PUSH_RATIO = 0.5  # 分割後の転送サンプル数が全体のこの割合以下のときだけ分割出力する
+
+class PeriodicSplit(NamedTuple):
+    prefix: np.ndarray    # 一度だけ出力するワード列（4の倍数、空の場合あり）
+    period: np.ndarray    # cyclicで繰り返すワード列（周期をunrollして4の倍数にしたもの）
+    period_samples: int   # パターン1周期のサンプル数
+    cyclic_samples: int   # prefixの後にperiodを繰り返して出力するサンプル数（ここで停止する。cyclic出力ではパターン1周期分）
+    total_samples: int    # 分割せずに描画した場合のサンプル数（ゼロ埋めやcyclic調整を含む）
+
+def prefix_function(tokens: List[int]) -> List[int]:
+    pi = [0] * len(tokens)
+    k = 0
+    for i in range(1, len(tokens)):
+        while k > 0 and tokens[i] != tokens[k]:
+            k = pi[k - 1]
+        if tokens[i] == tokens[k]:
+            k += 1
+        pi[i] = k
+    return pi
+
+def candidate_periods(starts: np.ndarray, words: np.ndarray, total: int) -> List[int]:
+    """末尾から2回以上繰り返すラン列の周期を、サンプル数の候補として小さい順に返す"""
+    lengths = np.diff(np.append(starts, total))
+    # 最後のランはパターン末尾で途切れている可能性があるため除外し、末尾側から照合する
+    reversed_lengths = lengths[:-1][::-1]
+    tokens = ((words[:-1][::-1].astype(np.int64) << 48) | reversed_lengths).tolist()
+    pi = prefix_function(tokens)
+    period_lengths = np.cumsum(reversed_lengths)
+    periods = set()
+    for length in range(1, len(tokens) + 1):
+        p = length - pi[length - 1]
+        if length >= 2 * p:
+            periods.add(int(period_lengths[p - 1]))
+    return sorted(periods)[:MAX_PERIOD_CANDIDATES]
+
+def periodic_start(starts: np.ndarray, words: np.ndarray, total: int, period: int) -> int:
+    """word(t) == word(t + period) が t >= start のすべてで成り立つ最小のstartを返す"""
+    # ワード列は区切り点の間で一定なので、区切り点（とその周期前）だけを比べればよい
+    points = np.union1d(starts, starts - period)
+    points = points[(points >= 0) & (points < total - period)]
+    if len(points) == 0:
+        return 0
+    current = words[np.searchsorted(starts, points, side='right') - 1]
+    shifted = words[np.searchsorted(starts, points + period, side='right') - 1]
+    mismatches = np.nonzero(current != shifted)[0]
+    if len(mismatches) == 0:
+        return 0
+    last = mismatches[-1]
+    return int(points[last + 1]) if last + 1 < len(points) else total - period
+
+def find_periodic_tails(starts: np.ndarray, words: np.ndarray, total: int) -> List[Tuple[int, int, int]]:
+    """(先頭部分のサンプル数, 周期のサンプル数, 繰り返し回数) の候補を返す"""
+    if len(starts) < 3:
+        return []
+    tails = []
+    for period in candidate_periods(starts, words, total):
+        repeats = (total - periodic_start(starts, words, total, period)) // period
+        if repeats >= 2:
+            tails.append((total - repeats * period, period, repeats))
+    return tails
+
+def minimal_cyclic_period(starts: np.ndarray, words: np.ndarray, total: int) -> int:
+    """total サンプルを繰り返すパターンが、totalを割り切る周期 p のk回の繰り返しになっている場合の最小の p"""
+    # 周期の境界をまたぐ変化も含めた変化点の数はkで割り切れる必要があるため、それ以外の候補は照合しない
+    changes = len(starts) - 1 + int(words[0] != words[-1])
+    for period in divisors(total)[:-1]:
+        if changes % (total // period) == 0 and periodic_start(starts, words, total, period) == 0:
+            return period
+    return total
+
+def split_cyclic_period(dataframes: Dict[str, ChannelPattern], sample_rate: int,
+                        memory_cap: Optional[int] = None) -> Optional[PeriodicSplit]:
+    """
+    cyclic出力するパターン全体が周期のk回の繰り返しになっていて、1周期分（4の倍数にunroll）のバッファの方が
+    通常のcyclicバッファより小さい場合のみ、先頭部分が空の PeriodicSplit を返す。
+    デバイスが繰り返す波形は変わらないため、サイクル数はパターン1周期（cyclic_samples）を単位に数えればよい。
+    """
+    compiled = plane_cache.compile(dataframes, sample_rate)
+    pattern_samples = compiled.original_total_samples
+    if pattern_samples == 0:
+        return None
+    in_range = compiled.starts < pattern_samples  # cyclic出力ではゼロ埋め部分は出力されない
+    period = minimal_cyclic_period(compiled.starts[in_range], compiled.words[in_range], pattern_samples)
+    unroll = 4 // math.gcd(period, 4)
+    total_samples = plan_cyclic_alignment(dataframes, sample_rate, memory_cap=memory_cap).total_samples
+    if period == pattern_samples or period * unroll >= total_samples:
+        return None
+    if memory_cap is not None and period * unroll * 2 > memory_cap:
+        return None  # 元のサンプルレートでは上限を超える（通常のcyclic調整でrescaleする）
+    words = np.tile(expand_words(compiled, 0, period), unroll)
+    return PeriodicSplit(np.zeros(0, dtype=np.uint16), words, period, pattern_samples, total_samples)
+
+def split_periodic(dataframes: Dict[str, ChannelPattern], sample_rate: int) -> Optional[PeriodicSplit]:
+    """先頭部分＋周期に分割して転送量が十分減る場合のみ PeriodicSplit を返す"""
+    compiled = plane_cache.compile(dataframes, sample_rate)
+    original_total_samples, total_samples = compiled.original_total_samples, compiled.total_samples
+    in_range = compiled.starts < original_total_samples  # ゼロ埋め部分は周期の検出に含めない
+    starts, words = compiled.starts[in_range], compiled.words[in_range]
+
+    best = None
+    for prefix_samples, period, _ in find_periodic_tails(starts, words, original_total_samples):
+        # 非cyclic出力する先頭部分も4の倍数にそろえ、その位相から周期を切り出す
+        prefix_samples = ((prefix_samples + 3) // 4) * 4
+        if prefix_samples + period > original_total_samples:
+            continue
+        unroll = 4 // math.gcd(period, 4)
+        pushed = prefix_samples + period * unroll
+        if best is None or pushed < best[0]:
+            best = (pushed, prefix_samples, period, unroll)
+
+    if best is None or best[0] > total_samples * MAX_PUSH_RATIO:
+        return None
+    _, prefix_samples, period, unroll = best
+    head = expand_words(compiled, 0, prefix_samples + period)
+    return PeriodicSplit(head[:prefix_samples], np.tile(head[prefix_samples:], unroll), period,
+                         original_total_samples - prefix_samples, total_samples)
@@ -0,0 +1,264 @@
+# pattern_render.py
+# チャネルごとのパターン（pattern_model.ChannelPattern）から、ADALM2000へ出力する
+# uint16 のサンプルワード列を生成するレンダリングエンジン。
+# CSVエクスポート、再生（prepare_output_job）、download_csv はすべてここを経由する。
+
+import math
+import numpy as np
+from typing import Dict, NamedTuple, Optional
+from pattern_model import ChannelPattern, TICKS_PER_SECOND, ticks_to_samples
+
+M2K_MAX_SAMPLE_RATE = 100000000  # ADALM2000のデジタル出力の最大サンプルレート
+
+class CyclicAlignment(NamedTuple):
+    strategy: str        # 'none' | 'unroll' | 'rescale' | 'rescale+unroll'
+    sample_rate: int     # 出力サンプルレート
+    period_samples: int  # パターン1周期のサンプル数（出力サンプルレートでの値）
+    repeats: int         # バッファ内に並べる周期数
+    total_samples: int   # バッファのサンプル数（4の倍数）
+
+class RenderedPattern(NamedTuple):
+    words: np.ndarray            # uint16のサンプルワード（bit i が i 番目のチャネル）
+    sample_rate: int             # 実際の出力サンプルレート（cyclic調整後）
+    total_samples: int           # ゼロ埋めを含むサンプル数
+    original_total_samples: int  # ゼロ埋め前のサンプル数
+    alignment: Optional[CyclicAlignment] = None  # cyclicの場合に選ばれた調整方法
+
+def channel_sample_counts(channel: ChannelPattern, sample_rate) -> np.ndarray:
+    """各行のサンプル数を整数tickから正確に計算する（端数は切り捨て）"""
+    return ticks_to_samples(channel.durations, sample_rate)
+
+def channel_run_lengths(channel: ChannelPattern, sample_rate) -> np.ndarray:
+    """各行を実際に出力するサンプル数（0サンプルの行も1サンプル分は出力される。従来のイテレータ実装と同じ挙動）"""
+    return np.maximum(channel_sample_counts(channel, sample_rate), 1)
+
+def is_exact_rate(channel: ChannelPattern, sample_rate: int) -> bool:
+    # すべての行が1サンプル以上の整数サンプルで表せるか
+    remainders = channel.durations % TICKS_PER_SECOND * sample_rate % TICKS_PER_SECOND
+    return bool(np.all(remainders == 0) and np.all(channel_sample_counts(channel, sample_rate) > 0))
+
+def original_samples(dataframes: Dict[str, ChannelPattern], sample_rate: int) -> int:
+    # 最も長いチャネルのサンプル数（ゼロ埋め前）
+    return max(int(channel_sample_counts(channel, sample_rate).sum()) for channel in dataframes.values())
+
+def plan_total_samples(dataframes: Dict[str, ChannelPattern], sample_rate: int):
+    """非cyclic出力の (original_total_samples, total_samples) を決める"""
+    return align_total_samples(original_samples(dataframes, sample_rate), ends_high(dataframes))
+
+def ends_high(dataframes: Dict[str, ChannelPattern]) -> bool:
+    # 末尾が'low'でないチャネルがあるか（空のチャネルは'low'とみなす）
+    return any(channel.states[-1] != 0 if not channel.empty else False for channel in dataframes.values())
+
+def align_total_samples(original_total_samples: int, trailing_high=False):
+    # ADALM2000の制約に合わせて4以上の４の倍数にする
+    total_samples = max(4, ((original_total_samples + 3) // 4) * 4)
+
+    # 既に4の倍数で、末尾が'low'でないチャネルがある場合はゼロ埋め用に4サンプル追加
+    if total_samples == original_total_samples and trailing_high:
+        total_samples += 4
+
+    return original_total_samples, total_samples
+
+def divisors(n: int):
+    small = [d for d in range(1, math.isqrt(n) + 1) if n % d == 0]
+    return sorted(set(small) | {n // d for d in small})
+
+def plan_cyclic_alignment(dataframes: Dict[str, ChannelPattern], sample_rate: int,
+                          max_rate: int = M2K_MAX_SAMPLE_RATE, memory_cap: Optional[int] = None) -> CyclicAlignment:
+    """
+    cyclic出力で、1周期をそのまま繰り返せる最小のバッファ（4の倍数）を求める。
+    - unroll : 元のサンプルレートのまま周期を k 回並べる
+    - rescale: 全行が整数サンプルで表せる場合、サンプル数の公約数でレートを下げて周期を短くする
+    元のサンプルレートのまま（必要ならunrollして）メモリ上限・レート上限を満たす場合はレートを変えない。
+    満たさない場合だけ、上限を満たす候補の中でレートの下げ幅が最小のものを選ぶ。
+    """
+    period_samples = original_samples(dataframes, sample_rate)
+    if period_samples == 0:
+        return CyclicAlignment('none', sample_rate, 0, 1, 4)
+
+    # 全行が正確に表せるなら、全行のサンプル数の最大公約数 d でレートを 1/d にしても周期は正確
+    common_divisor = 1
+    if all(is_exact_rate(channel, sample_rate) for channel in dataframes.values() if not channel.empty):
+        counts = np.concatenate([channel_sample_counts(channel, sample_rate) for channel in dataframes.values()])
+        common_divisor = math.gcd(int(np.gcd.reduce(counts)), sample_rate)
+
+    candidates = []
+    for d in divisors(common_divisor):
+        rate = sample_rate // d
+        period = period_samples // d
+        repeats = 4 // math.gcd(period, 4)
+        if d == 1:
+            strategy = 'none' if repeats == 1 else 'unroll'
+        else:
+            strategy = 'rescale' if repeats == 1 else 'rescale+unroll'
+        candidates.append(CyclicAlignment(strategy, rate, period, repeats, period * repeats))
+
+    feasible = [c for c in candidates
+                if c.sample_rate <= max_rate and (memory_cap is None or c.total_samples * 2 <= memory_cap)]
+    if candidates[0] in feasible:
+        return candidates[0]  # 元のサンプルレートのまま出力できる（ユーザーが指定したレートは必要な場合だけ変更する）
+    if feasible:
+        # 上限を満たす中で元のレートに最も近い（レートの下げ幅が最小の）もの
+        return max(feasible, key=lambda c: (c.sample_rate, -c.total_samples))
+    # どの候補も上限を満たさない場合はサンプル数が最小のもの
+    return min(candidates, key=lambda c: (c.total_samples, c.sample_rate))
+
+def channel_transitions(channel: ChannelPattern, sample_rate: int, original_total_samples: int) -> np.ndarray:
+    """1チャネルのビットプレーンを、レベルが反転するサンプル位置の昇順配列として返す"""
+    if channel.empty:
+        return np.zeros(0, dtype=np.int64)
+    run_lengths = channel_run_lengths(channel, sample_rate)
+    starts = np.concatenate(([0], np.cumsum(run_lengths)[:-1]))
+    changes = np.diff(channel.states, prepend=np.uint8(0)) != 0
+    # original_total_samples以降は最後の状態を保持せずゼロ埋め領域となる
+    in_range = starts < original_total_samples
+    positions = starts[in_range & changes]
+    if in_range.any() and channel.states[in_range][-1]:
+        positions = np.append(positions, original_total_samples)
+    return positions
+
+class CompiledPattern(NamedTuple):
+    """
+    パターンのコンパイル結果（全チャネルを合成したワードの変化点リスト）。
+    starts[k] から次の変化点（最後は total_samples）まで words[k] を出力する。
+    描画・エクスポート・統計・チャートはすべてこの形から作り、サンプル単位の処理はしない。
+    """
+    starts: np.ndarray           # ワードが変わるサンプル位置（int64、昇順、先頭は0）
+    words: np.ndarray            # その位置から出力するワード（uint16、隣り合う要素は必ず異なる）
+    sample_rate: int             # 実際の出力サンプルレート（cyclic調整後）
+    total_samples: int           # ゼロ埋めを含むサンプル数
+    original_total_samples: int  # ゼロ埋め前のサンプル数
+    alignment: Optional[CyclicAlignment] = None  # cyclicの場合に選ばれた調整方法
+
+    def run_lengths(self) -> np.ndarray:
+        """各ワードを出力するサンプル数"""
+        return np.diff(self.starts, append=self.total_samples)
+
+def sweep_transitions(planes):
+    """
+    (bit, 反転位置) の並びを全チャネル分マージし、(ワードが変わる位置, その位置からのワード) を返す。
+    各チャネルの反転位置は昇順なので、連結して安定ソートすると（timsortのラン併合で）チャネル数本のマージになり、
+    計算量は変化点の数だけで決まる。
+    """
+    positions = [np.zeros(1, dtype=np.int64)]
+    toggles = [np.zeros(1, dtype=np.uint16)]
+    for bit, plane in planes:
+        positions.append(plane)
+        toggles.append(np.full(len(plane), 1 << bit, dtype=np.uint16))
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    words = np.bitwise_xor.accumulate(np.concatenate(toggles)[order])
+    # 同じ位置での反転はまとめ、その位置の最後のワードを採る
+    last = np.append(positions[1:] != positions[:-1], True)
+    return merge_equal_runs(positions[last], words[last])
+
+def merge_equal_runs(starts: np.ndarray, words: np.ndarray):
+    # ワードが変化しない区切りは結合する
+    keep = np.concatenate(([True], words[1:] != words[:-1]))
+    return starts[keep], words[keep]
+
+def compile_planes(dataframes: Dict[str, ChannelPattern], planes, sample_rate: int, cyclic=False,
+                   memory_cap: Optional[int] = None) -> CompiledPattern:
+    # planes(sample_rate, original_total_samples) は各チャネルの (bit, 反転位置) を返す関数
+    if cyclic:
+        # 1周期分をコンパイルし、調整で決まった回数だけ位置をずらして並べる（memory_cap[bytes]はcyclic調整の上限）
+        alignment = plan_cyclic_alignment(dataframes, sample_rate, memory_cap=memory_cap)
+        period_length = alignment.total_samples // alignment.repeats
+        starts, words = sweep_transitions(planes(alignment.sample_rate, alignment.period_samples))
+        in_period = starts < period_length  # 周期末尾の反転は次の周期の先頭と重なる
+        starts, words = starts[in_period], words[in_period]
+        offsets = np.arange(alignment.repeats, dtype=np.int64) * period_length
+        starts, words = merge_equal_runs((starts[None, :] + offsets[:, None]).ravel(), np.tile(words, alignment.repeats))
+        return CompiledPattern(starts, words, int(alignment.sample_rate), alignment.total_samples,
+                               alignment.total_samples, alignment)
+
+    original_total_samples, total_samples = plan_total_samples(dataframes, sample_rate)
+    starts, words = sweep_transitions(planes(sample_rate, original_total_samples))
+    return CompiledPattern(starts, words, int(sample_rate), total_samples, original_total_samples)
+
+def compile_pattern(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False,
+                    memory_cap: Optional[int] = None) -> CompiledPattern:
+    """パターンを変化点リストにコンパイルする（ゼロ埋め・cyclic時の4の倍数調整を含む）"""
+    def planes(rate, original_total_samples):
+        return [(bit, channel_transitions(channel, rate, original_total_samples))
+                for bit, channel in enumerate(dataframes.values())]
+    return compile_planes(dataframes, planes, sample_rate, cyclic, memory_cap)
+
+def expand_words(compiled: CompiledPattern, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+    """[start, stop) のサンプルワード列を展開する（範囲外は展開しない）"""
+    if stop is None:
+        stop = compiled.total_samples
+    start, stop = max(0, start), min(stop, compiled.total_samples)
+    if stop <= start:
+        return np.zeros(0, dtype=np.uint16)
+    lo = np.searchsorted(compiled.starts, start, side='right') - 1
+    hi = np.searchsorted(compiled.starts, stop, side='left')
+    bounds = np.append(np.maximum(compiled.starts[lo:hi], start), stop)
+    return np.repeat(compiled.words[lo:hi], np.diff(bounds))
+
+def iter_word_chunks(compiled: CompiledPattern, chunk_samples: int):
+    """コンパイル済みパターンのワード列を chunk_samples ごとに生成する（全体をメモリに展開しない）"""
+    for start in range(0, compiled.total_samples, chunk_samples):
+        yield expand_words(compiled, start, start + chunk_samples)
+
+def channel_edges(compiled: CompiledPattern, bit: int):
+    """1チャネル分の (レベルが変わる位置, その位置からのレベル) を変化点リストから取り出す"""
+    levels = ((compiled.words >> bit) & 1).astype(np.uint8)
+    return merge_equal_runs(compiled.starts, levels)
+
+def transition_stats(compiled: CompiledPattern, num_channels: int) -> Dict[str, object]:
+    """変化点の数と、チャネルごとのエッジ数・HIGHのサンプル数（デューティ比）"""
+    lengths = compiled.run_lengths()
+    edges, high_samples = [], []
+    for bit in range(num_channels):
+        levels = (compiled.words >> bit) & 1
+        edges.append(int(np.count_nonzero(np.diff(levels, prepend=0))))
+        high_samples.append(int(lengths[levels == 1].sum()))
+    return {"transitions": len(compiled.starts), "edges": edges, "high_samples": high_samples,
+            "duty": [high / compiled.total_samples for high in high_samples]}
+
+class BitPlaneCache:
+    """
+    チャネルごとのビットプレーン（反転位置の配列）を保持し、編集で変更されたチャネル
+    （ChannelPattern.versionが変わったもの）だけを再展開する。変化点リストはキャッシュ済みのプレーンから合成する。
+    """
+    def __init__(self):
+        self._planes = {}  # チャネル名 -> (キー, 反転位置)
+        self.rendered = 0  # 展開したチャネル数
+        self.reused = 0    # キャッシュから再利用したチャネル数
+
+    def plane(self, name: str, channel: ChannelPattern, sample_rate: int, original_total_samples: int) -> np.ndarray:
+        key = (channel.version, int(sample_rate), original_total_samples)
+        cached = self._planes.get(name)
+        if cached is not None and cached[0] == key:
+            self.reused += 1
+            return cached[1]
+        positions = channel_transitions(channel, sample_rate, original_total_samples)
+        self._planes[name] = (key, positions)
+        self.rendered += 1
+        return positions
+
+    def compile(self, dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False,
+                memory_cap: Optional[int] = None) -> CompiledPattern:
+        """compile_pattern と同じ結果を、変更のないチャネルはキャッシュ済みのプレーンから合成する"""
+        def planes(rate, original_total_samples):
+            return [(bit, self.plane(name, channel, rate, original_total_samples))
+                    for bit, (name, channel) in enumerate(dataframes.items())]
+        return compile_planes(dataframes, planes, sample_rate, cyclic, memory_cap)
+
+    def clear(self):
+        self._planes.clear()
+
+plane_cache = BitPlaneCache()  # render_pattern が使用するチャネル単位のキャッシュ
+
+def render_pattern(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False,
+                   memory_cap: Optional[int] = None) -> RenderedPattern:
+    # 前回から変更されていないチャネルはキャッシュ済みのビットプレーンを再利用してコンパイルし、全体を展開する
+    compiled = plane_cache.compile(dataframes, sample_rate, cyclic, memory_cap)
+    return RenderedPattern(expand_words(compiled), compiled.sample_rate, compiled.total_samples,
+                           compiled.original_total_samples, compiled.alignment)
+
+def words_to_bits(words: np.ndarray, num_channels: int) -> np.ndarray:
+    """ワード列を (サンプル数, チャネル数) の0/1配列に展開する"""
+    return ((words[:, None] >> np.arange(num_channels, dtype=np.uint16)) & 1).astype(np.uint8)
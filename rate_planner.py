@@ -0,0 +1,90 @@
+# rate_planner.py
+# ADALM2000が正確に出力できるサンプルレートの候補を評価し、
+# バッファサイズとタイミング誤差のトレードオフからサンプルレートを選ぶ。
+
+import numpy as np
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from pattern_model import ChannelPattern, TICKS_PER_SECOND
+from pattern_render import (channel_run_lengths, is_exact_rate, original_samples, align_total_samples, ends_high,
+                            plan_cyclic_alignment, M2K_MAX_SAMPLE_RATE)
+
+M2K_BASE_CLOCK = 100000000  # デジタル出力のベースクロック（100 MHz）。出力レートはこれを整数で分周した値
+BYTES_PER_SAMPLE = 2  # uint16
+ESTIMATED_TRANSFER_RATE = 16 * 1024 * 1024  # 転送時間見積もり用のスループット [bytes/s]（USB/Ethernet経由の実測目安）
+
+class RateCandidate(NamedTuple):
+    sample_rate: int            # 候補のサンプルレート
+    output_rate: int            # 実際の出力サンプルレート（cyclic調整後）
+    total_samples: int          # ゼロ埋めを含むサンプル数
+    buffer_bytes: int           # 出力バッファのバイト数
+    channel_errors: Dict[str, float]  # チャネルごとの最大タイミング誤差 [s]
+    max_error: float            # 全チャネルでの最大タイミング誤差 [s]
+    transfer_time: float        # 転送時間の見積もり [s]
+
+def candidate_rates(max_rate: int = M2K_MAX_SAMPLE_RATE) -> List[int]:
+    """ベースクロックを整数で割り切れる（正確に出力できる）サンプルレートを昇順で返す"""
+    divisors = [n for n in range(1, int(np.sqrt(M2K_BASE_CLOCK)) + 1) if M2K_BASE_CLOCK % n == 0]
+    rates = set(divisors) | {M2K_BASE_CLOCK // n for n in divisors}
+    return sorted(rate for rate in rates if rate <= max_rate)
+
+def channel_timing_error(channel: ChannelPattern, sample_rate: int) -> float:
+    # 各エッジの出力時刻と指定時刻のずれの最大値（行ごとの切り捨てが累積した分を含む）
+    if channel.empty:
+        return 0.0
+    if is_exact_rate(channel, sample_rate):
+        return 0.0  # すべての行が整数サンプルで表せる
+    run_lengths = channel_run_lengths(channel, sample_rate)
+    output_times = np.cumsum(run_lengths) / sample_rate
+    target_times = np.cumsum(channel.durations) / TICKS_PER_SECOND
+    return float(np.max(np.abs(output_times - target_times)))
+
+def evaluate_rate(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False, original_total_samples=None,
+                  memory_cap: Optional[int] = None) -> RateCandidate:
+    if cyclic:
+        alignment = plan_cyclic_alignment(dataframes, sample_rate, memory_cap=memory_cap)
+        total_samples, output_rate = alignment.total_samples, alignment.sample_rate
+    else:
+        if original_total_samples is None:
+            original_total_samples = original_samples(dataframes, sample_rate)
+        _, total_samples = align_total_samples(original_total_samples, ends_high(dataframes))
+        output_rate = sample_rate
+    channel_errors = {name: channel_timing_error(channel, output_rate) for name, channel in dataframes.items()}
+    buffer_bytes = total_samples * BYTES_PER_SAMPLE
+    return RateCandidate(sample_rate, output_rate, total_samples, buffer_bytes, channel_errors,
+                         max(channel_errors.values(), default=0.0), buffer_bytes / ESTIMATED_TRANSFER_RATE)
+
+def plan_sample_rate(dataframes: Dict[str, ChannelPattern], tolerance: float, memory_cap: int,
+                     cyclic=False, rates: Optional[List[int]] = None) -> Tuple[Optional[RateCandidate], List[RateCandidate]]:
+    """
+    候補レートを低い順に評価し、誤差がtolerance[s]以内かつバッファがmemory_cap[bytes]以下で
+    バッファが最小のものを選ぶ。(選ばれた候補またはNone, 評価した全候補) を返す。
+    """
+    candidates = []
+    for sample_rate in rates if rates is not None else candidate_rates():
+        original_total_samples = original_samples(dataframes, sample_rate)
+        if original_total_samples * BYTES_PER_SAMPLE > memory_cap:
+            break  # これ以上レートを上げてもバッファは増える一方
+        candidate = evaluate_rate(dataframes, sample_rate, cyclic, original_total_samples, memory_cap)
+        if candidate.buffer_bytes > memory_cap or candidate.output_rate > M2K_MAX_SAMPLE_RATE:
+            continue  # cyclicの調整でバッファが上限を超える場合
+        candidates.append(candidate)
+        if candidate.max_error == 0:
+            break  # 誤差ゼロに達したら、より高いレートはバッファが大きくなるだけ
+
+    feasible = [c for c in candidates if c.max_error <= tolerance]
+    best = min(feasible, key=lambda c: (c.buffer_bytes, c.sample_rate), default=None)
+    return best, candidates
+
+def format_seconds(seconds: float) -> str:
+    if seconds == 0:
+        return "0"
+    for scale, unit in ((1, "s"), (1e-3, "ms"), (1e-6, "µs")):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+def format_bytes(num_bytes: int) -> str:
+    for scale, unit in ((2**30, "GB"), (2**20, "MB"), (2**10, "KB")):
+        if num_bytes >= scale:
+            return f"{num_bytes / scale:.3g} {unit}"
+    return f"{num_bytes} B"
@@ -0,0 +1,84 @@
+# render_cache.py
+# 描画済みのサンプルバッファを、パターン内容のハッシュ＋出力条件をキーとしてLRUで保持する。
+# リピート再生や、変更していないパターンの再生では描画をスキップする。
+
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional
+import numpy as np
+from pattern_model import ChannelPattern
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # キャッシュに保持するバッファの合計サイズの上限
+
+def pattern_digest(dataframes: Dict[str, ChannelPattern]) -> str:
+    """全チャネルのstate・durationの内容から計算したハッシュ（unitは表示用なので含めない）"""
+    h = hashlib.blake2b(digest_size=16)
+    for name, channel in dataframes.items():
+        h.update(name.encode())
+        h.update(len(channel).to_bytes(8, 'little'))
+        h.update(channel.states.tobytes())
+        h.update(channel.durations.tobytes())
+    return h.hexdigest()
+
+def value_nbytes(value) -> int:
+    # 値（NamedTupleやタプル）に含まれるnumpy配列の合計バイト数
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(value_nbytes(item) for item in value)
+    return 0
+
+class RenderCache:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic: bool,
+                 enabled_channels: Optional[Iterable[int]] = None) -> tuple:
+        channels = tuple(sorted(enabled_channels)) if enabled_channels is not None else None
+        return (pattern_digest(dataframes), int(sample_rate), bool(cyclic), channels)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return  # 上限を超える大きさのバッファは保持しない
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def get_or_render(self, key, render: Callable[[], object]):
+        """キャッシュにあればそれを返し、なければrender()の結果を保持して返す"""
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "bytes": self.nbytes}
+
+render_cache = RenderCache()  # アプリ全体で共有するキャッシュ
@@ -0,0 +1,62 @@
+# repeat_scheduler.py
+# リピート出力の各回の開始時刻を time.monotonic() の絶対時刻で決めるスケジューラ。
+# 各回の開始予定は t0 + i * interval で、前の回の処理時間やUI更新の遅れが次の回以降に累積しない。
+
+import asyncio
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+class IterationRecord(NamedTuple):
+    iteration: int
+    scheduled: float  # 開始予定（最初の回の開始からの経過秒）
+    actual: float     # 実際の開始（最初の回の開始からの経過秒）
+    jitter: float     # actual - scheduled [s]
+
+class RepeatScheduler:
+    def __init__(self, interval_seconds: float, poll_step: float = 0.05):
+        self.interval = max(0.0, float(interval_seconds))
+        self.poll_step = poll_step  # 停止要求を確認する間隔
+        self.t0 = None
+        self.records: List[IterationRecord] = []
+
+    def start(self):
+        """最初の回の開始時刻を基準にする"""
+        self.t0 = time.monotonic()
+
+    def deadline(self, iteration: int) -> float:
+        return self.t0 + iteration * self.interval
+
+    async def wait_for(self, iteration: int, should_stop: Callable[[], bool],
+                       on_countdown: Optional[Callable[[int], None]] = None) -> bool:
+        """
+        iteration回目の開始予定時刻まで待つ。停止要求があればFalseを返す。
+        on_countdownには残り秒数（切り上げ）が変わるたびに呼び出される。
+        """
+        deadline = self.deadline(iteration)
+        last_shown = None
+        while True:
+            if should_stop():
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            shown = int(remaining) + 1
+            if on_countdown and shown != last_shown:
+                on_countdown(shown)
+                last_shown = shown
+            # 最後は残り時間ちょうどだけ眠り、開始予定時刻を過ぎないようにする
+            await asyncio.sleep(min(self.poll_step, remaining))
+
+    def record(self, iteration: int) -> IterationRecord:
+        """iteration回目を実際に開始した時刻を記録する"""
+        now = time.monotonic()
+        if self.t0 is None:
+            self.t0 = now
+        scheduled = iteration * self.interval
+        actual = now - self.t0
+        record = IterationRecord(iteration, scheduled, actual, actual - scheduled)
+        self.records.append(record)
+        return record
+
+    def max_jitter(self) -> float:
+        return max((abs(r.jitter) for r in self.records), default=0.0)
@@ -0,0 +1,59 @@
+# sample_store.py
+# メモリに収まらない長さのパターン用に、サンプルワード列をcsv_files配下のファイルへ
+# チャンクごとに描画し、メモリマップとして読み出す。
+
+import os
+from pathlib import Path
+from typing import Dict, Optional
+import numpy as np
+from pattern_model import ChannelPattern
+from pattern_render import RenderedPattern, plane_cache, iter_word_chunks
+from render_cache import pattern_digest
+
+BUFFER_DIR = Path("../csv_files") / ".buffers"  # メモリマップ用ファイルの保存先
+DEFAULT_CHUNK_SAMPLES = 1 << 22  # 一度に描画するサンプル数（8 MB）
+MAX_BUFFER_FILES = 4  # 保持するメモリマップ用ファイルの数（古いものから削除）
+
+def buffer_path(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic: bool) -> Path:
+    return BUFFER_DIR / f"{pattern_digest(dataframes)}_{int(sample_rate)}_{'cyclic' if cyclic else 'once'}.u16"
+
+def prune_buffer_files(keep: Path):
+    files = sorted((f for f in BUFFER_DIR.glob("*.u16") if f != keep), key=lambda f: f.stat().st_mtime, reverse=True)
+    for f in files[MAX_BUFFER_FILES - 1:]:
+        try:
+            f.unlink()
+        except OSError as e:
+            print(f"Error deleting buffer file {f}: {e}")
+
+def render_to_memmap(dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False,
+                     chunk_samples: int = DEFAULT_CHUNK_SAMPLES, memory_cap: Optional[int] = None) -> RenderedPattern:
+    """
+    render_pattern と同じワード列をファイルにチャンクごとに書き込み、読み取り専用のnp.memmapとして返す。
+    同じパターン・条件のファイルが既にあれば描画せずに再利用する。
+    """
+    compiled = plane_cache.compile(dataframes, sample_rate, cyclic, memory_cap)
+    sample_rate, total_samples = compiled.sample_rate, compiled.total_samples
+
+    path = buffer_path(dataframes, sample_rate, cyclic)
+    if not path.exists() or path.stat().st_size != total_samples * 2:
+        BUFFER_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        words = np.memmap(temp_path, dtype=np.uint16, mode='w+', shape=(total_samples,))
+        position = 0
+        for chunk in iter_word_chunks(compiled, chunk_samples):
+            words[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        words.flush()
+        del words
+        os.replace(temp_path, path)  # 書き込みが完了したファイルだけを再利用の対象にする
+        prune_buffer_files(path)
+    else:
+        os.utime(path)
+
+    words = np.memmap(path, dtype=np.uint16, mode='r', shape=(total_samples,))
+    return RenderedPattern(words, int(sample_rate), total_samples, compiled.original_total_samples, compiled.alignment)
+
+def iter_buffer_chunks(words: np.ndarray, chunk_samples: int = DEFAULT_CHUNK_SAMPLES):
+    """メモリマップしたワード列を chunk_samples ごとのスライスとして順に返す（全体を読み込まない）"""
+    for start in range(0, len(words), chunk_samples):
+        yield words[start:start + chunk_samples]
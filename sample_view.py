@@ -0,0 +1,65 @@
+# sample_view.py
+# コンパイル済みパターン（pattern_render.CompiledPattern）を、展開せずにサンプル列として参照するビュー。
+# view[i] や view[a:b] で要求された範囲だけを変化点リストの二分探索で求めるため、
+# 数ギガサンプルのパターンでも特定時刻の出力確認やプレビューがすぐにできる。
+
+from typing import Dict, Iterator
+import numpy as np
+from pattern_model import ChannelPattern, TICKS_PER_SECOND, ticks_to_samples
+from pattern_render import CompiledPattern, plane_cache, expand_words, words_to_bits
+
+VIEW_CHUNK_SAMPLES = 1 << 16  # イテレーション時に一度に展開するサンプル数
+
+class SampleView:
+    def __init__(self, compiled: CompiledPattern):
+        self.compiled = compiled
+
+    @classmethod
+    def from_pattern(cls, dataframes: Dict[str, ChannelPattern], sample_rate: int, cyclic=False) -> 'SampleView':
+        """デバイスに出力されるのと同じサンプル列（ゼロ埋め・cyclic調整を含む）のビュー"""
+        return cls(plane_cache.compile(dataframes, sample_rate, cyclic))
+
+    @property
+    def sample_rate(self) -> int:
+        return self.compiled.sample_rate
+
+    def __len__(self) -> int:
+        return self.compiled.total_samples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return expand_words(self.compiled, start, stop)
+            return self._lookup(np.arange(start, stop, step, dtype=np.int64))
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"sample index out of range: {key}")
+        return int(self._lookup(index))
+
+    def _lookup(self, indices):
+        # 各サンプル位置を含む区間を、区間の開始位置（累積サンプル数）の二分探索で求める
+        compiled = self.compiled
+        return compiled.words[np.searchsorted(compiled.starts, indices, side='right') - 1]
+
+    def __iter__(self) -> Iterator[int]:
+        for start in range(0, len(self), VIEW_CHUNK_SAMPLES):
+            yield from expand_words(self.compiled, start, start + VIEW_CHUNK_SAMPLES).tolist()
+
+    def index_at(self, seconds: float) -> int:
+        """時刻[s]に出力されているサンプルの位置（時刻は1 ns単位に丸めてから換算する）"""
+        return int(ticks_to_samples(round(seconds * TICKS_PER_SECOND), self.sample_rate))
+
+    def at_time(self, seconds: float) -> int:
+        """時刻[s]に出力されているワード"""
+        return self[self.index_at(seconds)]
+
+    def window(self, start_seconds: float, end_seconds: float) -> np.ndarray:
+        """[start_seconds, end_seconds) のワード列"""
+        return self[self.index_at(start_seconds):self.index_at(end_seconds)]
+
+    def bits(self, start: int, stop: int, num_channels: int) -> np.ndarray:
+        """[start, stop) を (サンプル数, チャネル数) の0/1配列で返す"""
+        return words_to_bits(self[start:stop], num_channels)